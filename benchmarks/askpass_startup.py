@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Benchmark the startup time of op-askpass
+
+Runs the askpass entry point with a passphrase handed over through an
+inherited pipe (the path taken by op-unlock) and exits non-zero if the
+median wall time over a bare interpreter start is over the budget, so it
+can be used as a gate in CI (see tests/test_startup.py).
+"""
+import os
+import sys
+import time
+import statistics
+import subprocess
+from argparse import ArgumentParser
+
+
+def run_once(cmd):
+    rfd, wfd = os.pipe()
+    os.write(wfd, b'benchmark')
+    os.close(wfd)
+    env = os.environ.copy()
+    env['OP_ASKPASS_FD'] = str(rfd)
+
+    start = time.perf_counter()
+    rtn = subprocess.run(cmd, env=env, pass_fds=(rfd,),
+                         stdout=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    os.close(rfd)
+
+    if rtn.returncode != 0 or rtn.stdout.strip() != b'benchmark':
+        raise RuntimeError("askpass failed: {}".format(rtn))
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark op-askpass startup')
+    parser.add_argument("-n", "--runs", type=int, default=20)
+    parser.add_argument("-b", "--budget", type=float, default=0.02,
+                        help="Budget for the median startup in seconds")
+    parser.add_argument("-a", "--absolute", action="store_true",
+                        help="Apply the budget to the whole startup instead "
+                             "of the time over a bare interpreter start")
+    args = parser.parse_args()
+
+    bare = [sys.executable, '-c', 'print("benchmark")']
+    cmd = [sys.executable, '-m', 'py1password', 'askpass']
+    run_once(cmd)
+    baseline = statistics.median([run_once(bare) for i in range(args.runs)])
+    times = [run_once(cmd) for i in range(args.runs)]
+    median = statistics.median(times)
+
+    print("op-askpass startup: median {:.1f} ms, min {:.1f} ms, "
+          "interpreter {:.1f} ms, budget {:.1f} ms".format(
+              median * 1e3, min(times) * 1e3, baseline * 1e3,
+              args.budget * 1e3))
+    if not args.absolute:
+        median -= baseline
+    if median > args.budget:
+        print("FAILED: startup over budget", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Benchmark the JSON decoder backends on vault item lists
+
+Builds synthetic ``op list items`` payloads and reports the median parse
+time and the peak memory allocated while parsing for every installed
+backend of py1password.jsonbackend.
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import statistics
+import tracemalloc
+from argparse import ArgumentParser
+from py1password import jsonbackend
+
+
+def make_items(n, seed=0):
+    """Return a payload listing n items, shaped like op list items"""
+    rnd = random.Random(seed)
+    tags = ['ssh', 'prod', 'dev', 'web', 'db', 'backup', 'ci']
+    items = list()
+    for i in range(n):
+        items.append({
+            'uuid': uuid.UUID(int=rnd.getrandbits(128)).hex[:26],
+            'templateUuid': rnd.choice(['001', '005', '006', '110']),
+            'trashed': 'N',
+            'createdAt': '2020-01-01T00:00:00Z',
+            'updatedAt': '2020-06-01T12:34:56Z',
+            'changerUuid': 'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+            'itemVersion': rnd.randint(1, 20),
+            'vaultUuid': 'vaultvaultvaultvaultvaultv',
+            'overview': {
+                'ainfo': 'user{}@example.com'.format(i),
+                'ps': rnd.randint(0, 100),
+                'title': 'Item {}'.format(i),
+                'url': 'https://host{}.example.com/'.format(i),
+                'tags': rnd.sample(tags, rnd.randint(0, 3)),
+            },
+        })
+    return json.dumps(items).encode('utf-8')
+
+
+def measure(loads, data, runs):
+    times = list()
+    for i in range(runs):
+        start = time.perf_counter()
+        loads(data)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    obj = loads(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del obj
+    return statistics.median(times), peak
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark JSON decoder backends')
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("-s", "--sizes", type=int, nargs='+',
+                        default=[1000, 5000, 10000, 50000],
+                        help="Number of items in each payload")
+    args = parser.parse_args()
+
+    backends = [name for name in jsonbackend.BACKENDS
+                if jsonbackend._load(name) is not None]
+    print("{:>7} {:>9} {:>9} {:>11} {:>11}".format(
+        'items', 'size', 'backend', 'time (ms)', 'peak (MiB)'))
+    for n in args.sizes:
+        data = make_items(n)
+        for name in backends:
+            median, peak = measure(jsonbackend._load(name), data, args.runs)
+            print("{:>7} {:>8.1f}M {:>9} {:>11.1f} {:>11.1f}".format(
+                n, len(data) / 2**20, name, median * 1e3, peak / 2**20))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
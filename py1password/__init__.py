@@ -1,5 +1,21 @@
-__all__ = ['op', 'opssh']
+import sys
 
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+__all__ = ['op', 'opssh', 'agent', 'mirror', 'sync']
+
+
+class _package(type(sys)):
+    """Module type computing __version__ on first use
+
+    Finding the version imports subprocess and may run git, which would
+    otherwise be paid by every op-askpass start."""
+
+    @property
+    def __version__(self):
+        version = self.__dict__.get('_version_string', None)
+        if version is None:
+            from ._version import get_versions
+            version = self._version_string = get_versions()['version']
+        return version
+
+
+sys.modules[__name__].__class__ = _package
@@ -0,0 +1,32 @@
+"""Dispatch ``python -m py1password <command>`` to the console scripts
+
+Only the module for the requested command is imported, so askpass starts
+without loading argparse or the vault client."""
+import sys
+
+_COMMANDS = {
+    'askpass': ('py1password.askpass', 'main'),
+    'unlock': ('py1password.command_line', 'add_keys_to_agent'),
+    'getkey': ('py1password.command_line', 'download_key'),
+    'agent': ('py1password.command_line', 'agent_proxy'),
+    'mirror': ('py1password.command_line', 'vault_mirror'),
+    'sync': ('py1password.command_line', 'sync_documents'),
+    'diff': ('py1password.command_line', 'diff_vault'),
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in _COMMANDS:
+        print("usage: python -m py1password {{{}}} ...".format(
+            ','.join(sorted(_COMMANDS))), file=sys.stderr)
+        return 2
+
+    command = sys.argv.pop(1)
+    sys.argv[0] = 'op-' + command
+    module, func = _COMMANDS[command]
+    __import__(module)
+    return getattr(sys.modules[module], func)()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
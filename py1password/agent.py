@@ -0,0 +1,189 @@
+import os
+import sys
+import struct
+import socket
+import base64
+import threading
+import socketserver
+
+# ssh-agent protocol message numbers (draft-miller-ssh-agent)
+SSH_AGENT_FAILURE = 5
+SSH_AGENTC_REQUEST_IDENTITIES = 11
+SSH_AGENT_IDENTITIES_ANSWER = 12
+SSH_AGENTC_SIGN_REQUEST = 13
+
+
+def _recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _recv_msg(sock):
+    """Read one length prefixed agent message"""
+    hdr = _recv_exact(sock, 4)
+    if hdr is None:
+        return None
+    length, = struct.unpack('>I', hdr)
+    return _recv_exact(sock, length)
+
+
+def _send_msg(sock, msg):
+    sock.sendall(struct.pack('>I', len(msg)) + msg)
+
+
+def _get_string(msg, offset):
+    length, = struct.unpack_from('>I', msg, offset)
+    offset += 4
+    return msg[offset:offset + length], offset + length
+
+
+def _put_string(data):
+    return struct.pack('>I', len(data)) + data
+
+
+def read_public_keys(keys_path):
+    """Read the cached public keys in keys_path
+
+    Returns a dict of key blob to (name, comment) for every ``.pub`` file
+    which has a matching private key alongside it."""
+    keys = dict()
+    if not os.path.isdir(keys_path):
+        return keys
+
+    for fname in sorted(os.listdir(keys_path)):
+        if not fname.endswith('.pub'):
+            continue
+        name = fname[:-4]
+        if not os.path.isfile(os.path.join(keys_path, name)):
+            continue
+        with open(os.path.join(keys_path, fname), 'rb') as f:
+            parts = f.read().split(None, 2)
+        if len(parts) < 2:
+            continue
+        try:
+            blob = base64.b64decode(parts[1], validate=True)
+        except ValueError:
+            continue
+        comment = parts[2].strip() if len(parts) > 2 else name.encode()
+        keys[blob] = (name, comment)
+
+    return keys
+
+
+class _agentHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.upstream.connect(self.server.upstream_path)
+
+    def finish(self):
+        self.upstream.close()
+
+    def _forward(self, msg):
+        _send_msg(self.upstream, msg)
+        return _recv_msg(self.upstream)
+
+    def _upstream_identities(self):
+        reply = self._forward(bytes([SSH_AGENTC_REQUEST_IDENTITIES]))
+        if reply is None or reply[0] != SSH_AGENT_IDENTITIES_ANSWER:
+            return None
+        nkeys, = struct.unpack_from('>I', reply, 1)
+        offset = 5
+        keys = list()
+        for i in range(nkeys):
+            blob, offset = _get_string(reply, offset)
+            comment, offset = _get_string(reply, offset)
+            keys.append((blob, comment))
+        return keys
+
+    def _identities(self):
+        keys = self._upstream_identities()
+        if keys is None:
+            return bytes([SSH_AGENT_FAILURE])
+
+        loaded = set(blob for blob, comment in keys)
+        for blob, (name, comment) in self.server.vault_keys.items():
+            if blob not in loaded:
+                keys.append((blob, comment))
+
+        msg = bytes([SSH_AGENT_IDENTITIES_ANSWER])
+        msg += struct.pack('>I', len(keys))
+        for blob, comment in keys:
+            msg += _put_string(blob) + _put_string(comment)
+        return msg
+
+    def _is_loaded(self, blob):
+        keys = self._upstream_identities() or list()
+        return blob in [b for b, c in keys]
+
+    def _sign(self, msg):
+        blob, offset = _get_string(msg, 1)
+        if blob in self.server.vault_keys and not self._is_loaded(blob):
+            self.server.load_key(blob, self._is_loaded)
+        return self._forward(msg)
+
+    def handle(self):
+        while True:
+            msg = _recv_msg(self.request)
+            if not msg:
+                return
+
+            if msg[0] == SSH_AGENTC_REQUEST_IDENTITIES:
+                reply = self._identities()
+            elif msg[0] == SSH_AGENTC_SIGN_REQUEST:
+                reply = self._sign(msg)
+            else:
+                reply = self._forward(msg)
+
+            if reply is None:
+                return
+            _send_msg(self.request, reply)
+
+
+class sshAgentProxy(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    """ssh-agent proxy loading keys from the vault on demand
+
+    The proxy advertises the public keys cached in ``keys_path`` together
+    with the keys already held by the real agent. The private key is only
+    added to the real agent (and its passphrase fetched from the vault)
+    when the first signing request for it arrives."""
+    daemon_threads = True
+
+    def __init__(self, op, path, upstream_path=None):
+        self._op = op
+        self.upstream_path = upstream_path or os.environ['SSH_AUTH_SOCK']
+        self.vault_keys = read_public_keys(op._keys_path)
+        self._load_lock = threading.Lock()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _agentHandler)
+        finally:
+            os.umask(umask)
+
+    def load_key(self, blob, is_loaded):
+        """Add the private key matching blob to the real agent"""
+        name, comment = self.vault_keys[blob]
+        with self._load_lock:
+            # Another connection may have loaded it while we waited
+            if is_loaded(blob):
+                return
+            uuid = self._op.find_key_uuid(name)
+            if uuid is None:
+                if self._op._verbose:
+                    print("Unable to find key \"{}\" in vault ...."
+                          .format(name), file=sys.stderr)
+                return
+            self._op._ssh_add(uuid, name, self._op.get_passphrase(uuid))
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
@@ -0,0 +1,73 @@
+"""Entry point for op-askpass
+
+ssh-add runs op-askpass once for every key, so this module imports only
+os and sys at the top. Everything else is imported when the fast paths
+(inherited pipe, mirror, keyring) can't answer the prompt."""
+import os
+import sys
+
+
+def main():
+    """This routine is run as SSH_ASKPASS to get a passphrase"""
+    if os.environ.get('OP_TRACE_FILE', None):
+        from . import tracing
+        with tracing.span('op-askpass'):
+            return _main()
+    return _main()
+
+
+def _main():
+    if os.environ.get('OP_PROFILE', None):
+        from .profiling import run_child
+        return run_child(_askpass)
+    return _askpass()
+
+
+def _askpass():
+    # The parent may hand us the passphrase through an inherited pipe
+    fd = os.environ.get('OP_ASKPASS_FD', None)
+    if fd is not None:
+        try:
+            data = b''
+            chunk = os.read(int(fd), 4096)
+            while chunk:
+                data += chunk
+                chunk = os.read(int(fd), 4096)
+            os.close(int(fd))
+        except OSError:
+            pass
+        else:
+            print(data.decode('utf-8'), file=sys.stdout)
+            return
+
+    uuid = os.environ.get('SSH_KEY_UUID', None)
+    sd = os.environ.get('OP_SESSION_SUBDOMAIN', None)
+    timeout = float(os.environ.get('OP_SESSION_TIMEOUT', '10'))
+    keyring_timeout = os.environ.get('OP_KEYRING_TIMEOUT', None)
+
+    if uuid is None:
+        raise RuntimeError("Environmental Variable for Key Not Set")
+
+    if sd is None:
+        raise RuntimeError("Environmental Variable for SubDomain Not Set")
+
+    mirror_socket = os.environ.get('OP_MIRROR_SOCKET', None)
+    if mirror_socket is not None:
+        from . import mirror
+        passphrase = mirror.request(mirror_socket, {'passphrase': uuid},
+                                    timeout)
+        print(passphrase.decode('utf-8'), file=sys.stdout)
+        return
+
+    if keyring_timeout is not None:
+        from . import keyring
+        keyring_timeout = int(keyring_timeout)
+        passphrase = keyring.fetch(sd, uuid)
+        if passphrase is not None:
+            print(passphrase, file=sys.stdout)
+            return
+
+    from . import opssh
+    op = opssh.onepasswordSSH(subdomain=sd, verbose=0, timeout=timeout,
+                              keyring_timeout=keyring_timeout)
+    print(op.get_passphrase(uuid), file=sys.stdout)
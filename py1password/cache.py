@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class _inflight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class lrucache:
+    """Thread-safe LRU cache bounded by size with an optional TTL
+
+    Concurrent requests for a key which is not cached share a single call
+    of the fetch function."""
+
+    def __init__(self, max_bytes=4 * 1024 * 1024, ttl=None):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._size = 0
+        self._inflight = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _lookup(self, key):
+        entry = self._data.get(key, None)
+        if entry is None:
+            return None
+        value, size, expires = entry
+        if expires is not None and time.time() > expires:
+            self._remove(key)
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        value, size, expires = self._data.pop(key)
+        self._size -= size
+
+    def _insert(self, key, value, size):
+        if key in self._data:
+            self._remove(key)
+        if size > self._max_bytes:
+            return
+        expires = None if self._ttl is None else time.time() + self._ttl
+        self._data[key] = (value, size, expires)
+        self._size += size
+        while self._size > self._max_bytes:
+            self._remove(next(iter(self._data)))
+
+    def get(self, key, fetch):
+        """Return the value for key, calling fetch() on a miss
+
+        fetch must return a tuple of (value, size in bytes)."""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+            flight = self._inflight.get(key, None)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = _inflight()
+                self._inflight[key] = flight
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value, size = fetch()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            flight.value = value
+            with self._lock:
+                self._insert(key, value, size)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def hit_ratio(self):
+        total = self.hits + self.coalesced + self.misses
+        if not total:
+            return 0.0
+        return (self.hits + self.coalesced) / total
+
+
+class negativecache:
+    """Short lived record of lookups which found nothing
+
+    Entries are kept in memory and, if path is given, in a JSON file so
+    that later processes can skip lookups known to fail."""
+
+    def __init__(self, ttl=30, path=None):
+        self._ttl = ttl
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        if self._path is None:
+            return dict()
+        try:
+            with open(self._path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _save(self, drop=None):
+        now = time.time()
+        entries = self._load()
+        entries.update(self._entries)
+        entries.pop(drop, None)
+        entries = {k: v for k, v in entries.items() if v > now}
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self._path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self._path)
+
+    def add(self, key):
+        if not self._ttl:
+            return
+        with self._lock:
+            self._entries[key] = time.time() + self._ttl
+            if self._path is not None:
+                self._save()
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            if self._path is not None:
+                self._save(drop=key)
+
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._entries.get(key, None)
+            if expires is None:
+                return False
+            if time.time() > expires:
+                del self._entries[key]
+                return False
+            return True
+
+
+class snapshotcache:
+    """On disk copy of the last good output of each op command
+
+    Files are private to the user (0600 in a 0700 directory) as they hold
+    vault contents."""
+
+    def __init__(self, path):
+        self._path = path
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+    def _filename(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._path, digest)
+
+    def store(self, key, data):
+        fd, tmp = tempfile.mkstemp(dir=self._path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._filename(key))
+
+    def store_file(self, key, src):
+        """Store the contents of the binary file src"""
+        src.seek(0)
+        fd, tmp = tempfile.mkstemp(dir=self._path)
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(src, f)
+        os.replace(tmp, self._filename(key))
+
+    def load(self, key, max_age=None):
+        """Return (data, age in seconds) or None if missing or too old"""
+        filename = self._filename(key)
+        try:
+            age = time.time() - os.stat(filename).st_mtime
+            if max_age is not None and age > max_age:
+                return None
+            with open(filename, 'rb') as f:
+                return f.read(), age
+        except OSError:
+            return None
+
+
+class latencystats:
+    """Running average of the time taken by each kind of call
+
+    Samples are collected in memory and merged into a JSON file by
+    save(), so estimates improve across runs."""
+
+    def __init__(self, path=None, weight=0.2):
+        self._path = path
+        self._weight = weight
+        self._lock = threading.Lock()
+        self._samples = dict()
+        self._saved = self._load()
+
+    def _load(self):
+        if self._path is None:
+            return dict()
+        try:
+            with open(self._path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def record(self, kind, seconds):
+        with self._lock:
+            self._samples.setdefault(kind, list()).append(seconds)
+
+    def estimate(self, kind, default=None):
+        """Return the expected time for one call of kind"""
+        with self._lock:
+            samples = self._samples.get(kind, None)
+            if samples:
+                return sum(samples) / len(samples)
+        return self._saved.get(kind, default)
+
+    def save(self):
+        if self._path is None:
+            return
+        with self._lock:
+            samples, self._samples = self._samples, dict()
+        if not samples:
+            return
+
+        saved = self._load()
+        for kind, values in samples.items():
+            for value in values:
+                if kind in saved:
+                    saved[kind] += self._weight * (value - saved[kind])
+                else:
+                    saved[kind] = value
+        self._saved = saved
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self._path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp, self._path)
@@ -1,7 +1,18 @@
 import os
 import sys
+import json
+import tempfile
 from argparse import ArgumentParser
 import py1password.opssh as opssh
+import py1password.agent as agent
+import py1password.lock as lock
+import py1password.mirror as mirror
+import py1password.sync as sync
+import py1password.profiling as profiling
+import py1password.tracing as tracing
+from py1password.op import onepassword, default_cache_path
+from py1password.cache import negativecache
+from py1password.askpass import main as askpass  # noqa: F401
 
 
 def _add_default_parser(parser):
@@ -9,31 +20,148 @@ def _add_default_parser(parser):
                         default='my',
                         help="1password domain to use")
     parser.add_argument("-t", "--timeout", metavar='timeout',
-                        default=60,
+                        default=60, type=float,
                         help="Timeout for 1password cli client")
     parser.add_argument("-s", "--ssh-keys", metavar='path',
                         default=None, dest='keys_path',
                         help="Path to ssh keys")
+    parser.add_argument("-T", "--token-file", metavar='path',
+                        default=None, dest='token_file',
+                        help="Authenticate non-interactively with the "
+                             "service account token in path")
+    parser.add_argument("-k", "--keyring", metavar='seconds',
+                        default=None, type=int, dest='keyring_timeout',
+                        help="Cache passphrases in the kernel keyring for "
+                             "seconds")
+    parser.add_argument("-r", "--rate-limit", metavar='rate[:burst]',
+                        default=None, dest='rate_limit',
+                        help="Limit calls to the 1password cli to rate per "
+                             "second across all processes")
+    parser.add_argument("--deadline", metavar='seconds',
+                        default=None, type=float, dest='deadline',
+                        help="Give up if the whole run takes longer than "
+                             "seconds")
+    parser.add_argument("-m", "--mirror", metavar='socket',
+                        default=None, dest='mirror',
+                        help="Read the vault through the mirror listening "
+                             "on socket")
+    parser.add_argument("-O", "--offline", metavar='max_stale',
+                        default=None, type=float, dest='max_stale',
+                        help="Keep a local snapshot of the vault and serve "
+                             "from it, if no older than max_stale seconds, "
+                             "when 1password can't be reached")
+    parser.add_argument("-z", "--zygote", action="store_true",
+                        dest='zygote',
+                        help="Answer askpass prompts from a pre-forked "
+                             "process")
+    parser.add_argument("--profile", metavar='file',
+                        default=None, dest='profile',
+                        help="Profile the run, including askpass, and dump "
+                             "pstats to file")
+    parser.add_argument("--trace", metavar='file',
+                        default=None, dest='trace',
+                        help="Trace the run, including askpass, and write a "
+                             "Chrome trace (JSON) to file")
+    parser.add_argument("-c", "--persistent-cache", action="store_true",
+                        dest='persistent_cache',
+                        help="Keep lookup results in the local cache between "
+                             "runs")
+    parser.add_argument("-S", "--item-store", action="store_true",
+                        dest='item_store',
+                        help="Keep an indexed copy of the vault overview in "
+                             "a local SQLite database")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-v", "--verbose", action="store_true")
     group.add_argument("-q", "--quiet", action="store_true")
 
 
-def askpass():
-    """This routine is run as SSH_ASKPASS to get a passphrase"""
+def _client(args, cls=opssh.onepasswordSSH, **extra):
+    """Construct a vault client of class cls from the common arguments"""
+    kwargs = dict(subdomain=args.domain, timeout=args.timeout,
+                  verbose=args.verbose, quiet=args.quiet,
+                  token_file=args.token_file,
+                  rate_limit=args.rate_limit,
+                  persistent_cache=args.persistent_cache,
+                  item_store=args.item_store,
+                  deadline=args.deadline,
+                  offline=args.max_stale is not None,
+                  max_stale=args.max_stale,
+                  mirror=args.mirror)
+    if issubclass(cls, opssh.onepasswordSSH):
+        kwargs.update(keys_path=args.keys_path,
+                      keyring_timeout=args.keyring_timeout,
+                      zygote=args.zygote)
+    kwargs.update(extra)
+    return cls(**kwargs)
 
-    uuid = os.environ.get('SSH_KEY_UUID', None)
-    sd = os.environ.get('OP_SESSION_SUBDOMAIN', None)
-    timeout = int(os.environ.get('OP_SESSION_TIMEOUT', '10'))
 
-    if uuid is None:
-        raise RuntimeError("Environmental Variable for Key Not Set")
+def _print_stats(op):
+    for key, value in sorted(op.stats().items()):
+        print("{:<20} {}".format(key, value), file=sys.stderr)
 
-    if sd is None:
-        raise RuntimeError("Environmental Variable for SubDomain Not Set")
 
-    op = opssh.onepasswordSSH(subdomain=sd, verbose=0, timeout=timeout)
-    print(op.get_passphrase(uuid), file=sys.stdout)
+def _profiled(args, func, *fargs):
+    """Run func, under cProfile and tracing if asked to"""
+    if args.trace is not None:
+        tracing.start(args.trace)
+        try:
+            with tracing.span(os.path.basename(sys.argv[0])):
+                return _profiled_run(args, func, *fargs)
+        finally:
+            tracing.finish(args.trace)
+    return _profiled_run(args, func, *fargs)
+
+
+def _profiled_run(args, func, *fargs):
+    if args.profile is None:
+        return func(*fargs)
+    return profiling.run(args.profile, func, *fargs)
+
+
+def _print_plan(plan):
+    print(json.dumps(plan, indent=2, sort_keys=True))
+
+
+def _check_missing(tag, args):
+    """Fail early if the lookup is recorded as missing in the cache"""
+    if not args.persistent_cache:
+        return
+
+    path = os.path.join(default_cache_path(),
+                        '{}-negative.json'.format(args.domain))
+    missing = negativecache(path=path)
+
+    if args.all:
+        if 'tag:' + tag in missing:
+            raise RuntimeError("Unable to find SSH keys in database (cached)")
+    elif args.keys and all('key:{}:{}'.format(tag, key) in missing
+                           for key in args.keys):
+        raise RuntimeError("Unable to find keys {} in vault (cached)"
+                           .format(', '.join(args.keys)))
+
+
+# Arguments which change what a run prints but not what it does
+_OUTPUT_ARGS = ('verbose', 'quiet', 'profile', 'trace')
+
+
+def _single_flight(name, args, func):
+    """Run func once for concurrent runs with the same arguments"""
+    keys_path = args.keys_path
+    if keys_path is None:
+        keys_path = os.path.join(os.environ['HOME'], ".ssh")
+
+    key = [name, os.path.abspath(keys_path),
+           os.environ.get('SSH_AUTH_SOCK', None),
+           sorted((arg, value) for arg, value in vars(args).items()
+                  if arg not in _OUTPUT_ARGS)]
+
+    flight = lock.singleflight(os.path.join(default_cache_path(), 'lock'),
+                               key)
+    result = flight.run(func)
+    if flight.waited and not args.quiet:
+        print("Reused result of concurrent {} run ....".format(name),
+              file=sys.stderr)
+    return result
 
 
 def add_keys_to_agent():
@@ -45,6 +173,12 @@ def add_keys_to_agent():
     parser.add_argument("-D", "--delete",
                         action="store_true", dest="delete", default=False,
                         help="Detete keys from agent before starting")
+    parser.add_argument("--explain", action="store_true", dest="explain",
+                        help="Print the calls the run would make and exit")
+    parser.add_argument("-p", "--priority", metavar='keyname',
+                        action="append", dest="priority", default=None,
+                        help="Add keyname to the agent first (may be "
+                             "given more than once)")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("-a", "--all",
                        action="store_true", dest="all",
@@ -55,13 +189,24 @@ def add_keys_to_agent():
 
     args = parser.parse_args()
 
-    op = opssh.onepasswordSSH(subdomain=args.domain, timeout=args.timeout,
-                              verbose=args.verbose, quiet=args.quiet,
-                              keys_path=args.keys_path)
-    if args.all:
-        op.add_keys_to_agent(delete=args.delete)
-    else:
-        op.add_keys_to_agent(keys=args.keys, delete=args.delete)
+    def _unlock():
+        op = _client(args)
+        if args.explain:
+            return op.plan('unlock', None if args.all else args.keys,
+                           delete=args.delete)
+        if args.all:
+            op.add_keys_to_agent(delete=args.delete, priority=args.priority)
+        else:
+            op.add_keys_to_agent(keys=args.keys, delete=args.delete,
+                                 priority=args.priority)
+        if args.verbose:
+            _print_stats(op)
+        return True
+
+    _check_missing('SSH_KEY', args)
+    result = _profiled(args, _single_flight, 'op-unlock', args, _unlock)
+    if args.explain:
+        _print_plan(result)
 
 
 def download_key():
@@ -71,6 +216,8 @@ def download_key():
     parser.add_argument("-o", "--overwrite",
                         action="store_true", dest="overwrite",
                         help="Overwrite file if exists")
+    parser.add_argument("--explain", action="store_true", dest="explain",
+                        help="Print the calls the run would make and exit")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("-a", "--all",
                        action="store_true", dest="all",
@@ -81,11 +228,207 @@ def download_key():
 
     args = parser.parse_args()
 
-    op = opssh.onepasswordSSH(subdomain=args.domain, timeout=args.timeout,
-                              verbose=args.verbose, quiet=args.quiet,
-                              keys_path=args.keys_path)
+    def _download():
+        op = _client(args)
 
-    if args.all:
-        op.save_ssh_keys(overwrite=args.overwrite)
+        if args.explain:
+            return op.plan('getkey', None if args.all else args.keys,
+                           overwrite=args.overwrite)
+        if args.all:
+            op.save_ssh_keys(overwrite=args.overwrite)
+        else:
+            op.save_ssh_keys(key_names=args.keys, overwrite=args.overwrite)
+        if args.verbose:
+            _print_stats(op)
+        return True
+
+    _check_missing('SSH_KEY_FILE', args)
+    result = _profiled(args, _single_flight, 'op-getkey', args, _download)
+    if args.explain:
+        _print_plan(result)
+
+
+def agent_proxy():
+    parser = ArgumentParser(description='Run an ssh-agent proxy which loads '
+                                        'keys from the 1password vault on '
+                                        'first use')
+    _add_default_parser(parser)
+
+    parser.add_argument("-a", "--address", metavar='bind_address',
+                        default=None, dest='address',
+                        help="Bind the agent to the unix socket "
+                             "bind_address")
+
+    args = parser.parse_args()
+
+    if 'SSH_AUTH_SOCK' not in os.environ:
+        raise RuntimeError("No ssh-agent found (SSH_AUTH_SOCK not set)")
+
+    address = args.address
+    if address is None:
+        rundir = os.environ.get('XDG_RUNTIME_DIR', None)
+        if rundir is None:
+            rundir = os.path.join(os.environ['HOME'], '.ssh')
+        address = os.path.join(rundir, 'op-agent.sock')
+
+    def _serve():
+        op = _client(args)
+
+        server = agent.sshAgentProxy(op, address)
+        print("SSH_AUTH_SOCK={}; export SSH_AUTH_SOCK;".format(address))
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    _profiled(args, _serve)
+
+
+def vault_mirror():
+    parser = ArgumentParser(description='Serve the 1password vault to local '
+                                        'users through a unix socket')
+    _add_default_parser(parser)
+
+    parser.add_argument("-a", "--address", metavar='bind_address',
+                        default=None, dest='address',
+                        help="Bind the mirror to the unix socket "
+                             "bind_address")
+    parser.add_argument("-g", "--group", metavar='group',
+                        default=None, dest='group',
+                        help="Allow members of group to use the mirror "
+                             "(needs --address)")
+    parser.add_argument("-l", "--list-ttl", metavar='seconds',
+                        default=300, type=float, dest='list_ttl',
+                        help="Refresh the item list after seconds")
+
+    args = parser.parse_args()
+
+    if args.mirror is not None:
+        raise RuntimeError("A vault mirror can't read from another mirror")
+    os.environ.pop('OP_MIRROR_SOCKET', None)
+
+    # The default locations are private to the user
+    if args.group is not None and args.address is None:
+        raise RuntimeError("A mirror shared with a group needs an address "
+                           "in a directory the group can reach")
+
+    address = args.address
+    if address is None:
+        rundir = os.environ.get('XDG_RUNTIME_DIR', None)
+        if rundir is None:
+            rundir = default_cache_path()
+        address = os.path.join(rundir, 'op-mirror.sock')
+
+    def _serve():
+        op = _client(args, deadline=None, mirror=None, zygote=False)
+
+        server = mirror.vaultMirror(op, address, group=args.group,
+                                    list_ttl=args.list_ttl)
+        print("OP_MIRROR_SOCKET={}; export OP_MIRROR_SOCKET;"
+              .format(address))
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    _profiled(args, _serve)
+
+
+def sync_documents():
+    parser = ArgumentParser(description='Download tagged documents from the '
+                                        '1password vault')
+    _add_default_parser(parser)
+
+    parser.add_argument("-o", "--overwrite",
+                        action="store_true", dest="overwrite",
+                        help="Download documents even if unchanged")
+    parser.add_argument("-j", "--jobs", metavar='jobs',
+                        default=4, type=int, dest='jobs',
+                        help="Number of concurrent downloads")
+    parser.add_argument('targets', metavar='TAG:DIR[:MODE]', nargs="+",
+                        help="Save documents tagged TAG into DIR with file "
+                             "mode MODE (octal, default 600)")
+
+    args = parser.parse_args()
+
+    targets = dict(sync.parse_target(spec) for spec in args.targets)
+
+    def _sync():
+        op = _client(args, sync.onepasswordSync, jobs=args.jobs)
+        op.sync(targets, args.overwrite)
+        return op
+
+    op = _profiled(args, _sync)
+    if args.verbose:
+        _print_stats(op)
+
+
+def _load_list(path):
+    """Load an item list, empty if the file doesn't exist"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return list()
+
+
+def _save_list(path, items):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(items, f)
+    os.replace(tmp, path)
+
+
+def _print_diff(delta, old, new):
+    titles = dict((obj['uuid'], obj['overview'].get('title', ''))
+                  for obj in old + new)
+    for kind, mark in (('added', '+'), ('removed', '-'),
+                       ('modified', '~')):
+        for uuid in delta[kind]:
+            print("{} {} {}".format(mark, uuid, titles[uuid]))
+
+
+def diff_vault():
+    parser = ArgumentParser(description='Show the items added, removed and '
+                                        'modified in the 1password vault '
+                                        'since the last run')
+    _add_default_parser(parser)
+
+    parser.add_argument("-j", "--json",
+                        action="store_true", dest="json",
+                        help="Print the diff as JSON")
+    parser.add_argument("-n", "--no-save",
+                        action="store_true", dest="no_save",
+                        help="Don't record the vault as the baseline for "
+                             "the next run")
+    parser.add_argument('old', metavar='file', nargs="?", default=None,
+                        help="Compare with the item list in file instead "
+                             "of the baseline")
+
+    args = parser.parse_args()
+
+    baseline = os.path.join(default_cache_path(),
+                            '{}-baseline.json'.format(args.domain))
+    old = _load_list(baseline if args.old is None else args.old)
+
+    def _diff():
+        op = _client(args, onepassword)
+        return op, op.diff_items(old)
+
+    op, delta = _profiled(args, _diff)
+
+    if args.json:
+        print(json.dumps(delta, indent=2, sort_keys=True))
     else:
-        op.save_ssh_keys(key_names=args.keys, overwrite=args.overwrite)
+        _print_diff(delta, old, op._items)
+
+    if args.old is None and not args.no_save:
+        _save_list(baseline, op._items)
+
+    return 1 if any(delta.values()) else 0
@@ -0,0 +1,36 @@
+def version(obj):
+    """Return the version of an item from the item list"""
+    return [obj.get('itemVersion'), obj.get('updatedAt')]
+
+
+def versions(items):
+    """Map the uuids of an item list to their versions"""
+    return dict((obj['uuid'], version(obj)) for obj in items)
+
+
+def diff_versions(old, new):
+    """Compare two mappings of uuid to version
+
+    Returns a dict of the sorted uuids which were added, removed and
+    modified going from old to new."""
+    added = list()
+    modified = list()
+    for uuid, ver in new.items():
+        if uuid not in old:
+            added.append(uuid)
+        elif old[uuid] != ver:
+            modified.append(uuid)
+    removed = [uuid for uuid in old if uuid not in new]
+
+    return {'added': sorted(added), 'removed': sorted(removed),
+            'modified': sorted(modified)}
+
+
+def diff(old, new):
+    """Compare two item lists (as returned by op list items)"""
+    return diff_versions(versions(old), versions(new))
+
+
+def changed(delta):
+    """Return the uuids which were added or modified"""
+    return delta['added'] + delta['modified']
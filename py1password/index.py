@@ -0,0 +1,178 @@
+import os
+import mmap
+import struct
+import tempfile
+
+# Layout of the index file, all integers little endian:
+#
+#   header   magic, version, item count, tag count and the offsets of
+#            the sections below
+#   items    (uuid offset, uuid length, title offset, title length)
+#            for each item, sorted by uuid
+#   titles   item numbers sorted by title
+#   tags     (tag offset, tag length, first member, member count) for
+#            each tag, sorted by tag
+#   members  item numbers of the items with each tag
+#   strings  utf-8 text referred to by the offsets above
+MAGIC = b'OPIX'
+VERSION = 1
+_HEADER = struct.Struct('<4sIIIIIIII')
+_ITEM = struct.Struct('<IIII')
+_TAG = struct.Struct('<IIII')
+_NUM = struct.Struct('<I')
+
+
+def write(path, items):
+    """Atomically write the index of an item list to path"""
+    entries = sorted((obj['uuid'].encode('utf-8'),
+                      obj['overview'].get('title', '').encode('utf-8'),
+                      obj['overview'].get('tags', []))
+                     for obj in items)
+
+    strings = bytearray()
+
+    def _string(text):
+        offset = len(strings)
+        strings.extend(text)
+        return offset, len(text)
+
+    records = bytearray()
+    members = dict()
+    for n, (uuid, title, tags) in enumerate(entries):
+        records.extend(_ITEM.pack(*(_string(uuid) + _string(title))))
+        for tag in set(tags):
+            members.setdefault(tag.encode('utf-8'), list()).append(n)
+
+    titles = bytearray()
+    for n in sorted(range(len(entries)), key=lambda n: entries[n][1]):
+        titles.extend(_NUM.pack(n))
+
+    tag_records = bytearray()
+    member_list = bytearray()
+    first = 0
+    for tag in sorted(members):
+        tag_records.extend(_TAG.pack(*(_string(tag) +
+                                       (first, len(members[tag])))))
+        for n in members[tag]:
+            member_list.extend(_NUM.pack(n))
+        first += len(members[tag])
+
+    items_off = _HEADER.size
+    titles_off = items_off + len(records)
+    tags_off = titles_off + len(titles)
+    members_off = tags_off + len(tag_records)
+    strings_off = members_off + len(member_list)
+    header = _HEADER.pack(MAGIC, VERSION, len(entries), len(members),
+                          items_off, titles_off, tags_off, members_off,
+                          strings_off)
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for data in (header, records, titles, tag_records, member_list,
+                         strings):
+                f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class itemindex:
+    """Read only view of an index file written by write()
+
+    The file is mapped into memory and searched in place, so opening it
+    and looking up a uuid, title or tag takes the same time whatever the
+    size of the vault."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < _HEADER.size:
+            self.close()
+            raise ValueError("\"{}\" is not an item index".format(path))
+        (magic, version, self._count, self._tag_count, self._items,
+         self._titles, self._tags, self._members,
+         self._strings) = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("\"{}\" is not an item index".format(path))
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self._count
+
+    def _string(self, offset, length):
+        start = self._strings + offset
+        return self._map[start:start + length]
+
+    def _item(self, n):
+        record = _ITEM.unpack_from(self._map, self._items + n * _ITEM.size)
+        return self._string(*record[:2]), self._string(*record[2:])
+
+    def _title_item(self, n):
+        return _NUM.unpack_from(self._map, self._titles + n * _NUM.size)[0]
+
+    def _tag(self, n):
+        record = _TAG.unpack_from(self._map, self._tags + n * _TAG.size)
+        return self._string(*record[:2]), record[2], record[3]
+
+    @staticmethod
+    def _bisect(count, key, value):
+        """Return the first n for which value(n) >= key"""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if value(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find_uuid(self, uuid):
+        key = uuid.encode('utf-8')
+        n = self._bisect(self._count, key, lambda n: self._item(n)[0])
+        if n < self._count and self._item(n)[0] == key:
+            return n
+        return None
+
+    def __contains__(self, uuid):
+        return self._find_uuid(uuid) is not None
+
+    def title(self, uuid):
+        """Return the title of an item, or None if it is not indexed"""
+        n = self._find_uuid(uuid)
+        if n is None:
+            return None
+        return self._item(n)[1].decode('utf-8')
+
+    def find_title(self, title):
+        """Return the uuids of the items with the given title"""
+        key = title.encode('utf-8')
+        n = self._bisect(self._count, key,
+                         lambda n: self._item(self._title_item(n))[1])
+        uuids = list()
+        while n < self._count:
+            uuid, value = self._item(self._title_item(n))
+            if value != key:
+                break
+            uuids.append(uuid.decode('utf-8'))
+            n += 1
+        return uuids
+
+    def find_tag(self, tag):
+        """Return the uuids of the items with the given tag"""
+        key = tag.encode('utf-8')
+        n = self._bisect(self._tag_count, key, lambda n: self._tag(n)[0])
+        if n == self._tag_count:
+            return list()
+        value, first, count = self._tag(n)
+        if value != key:
+            return list()
+        start = self._members + first * _NUM.size
+        return [self._item(_NUM.unpack_from(self._map, start + i *
+                                            _NUM.size)[0])[0].decode('utf-8')
+                for i in range(count)]
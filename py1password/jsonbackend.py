@@ -0,0 +1,53 @@
+import os
+import json
+
+# Decoder selected with OP_JSON_BACKEND, otherwise the fastest installed
+ENV = 'OP_JSON_BACKEND'
+BACKENDS = ('orjson', 'simdjson', 'json')
+
+
+def _stdlib_loads(data):
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def _load(name):
+    """Return the loads function of a backend, or None if not installed"""
+    if name == 'orjson':
+        try:
+            import orjson
+        except ImportError:
+            return None
+        return orjson.loads
+    if name == 'simdjson':
+        try:
+            import simdjson
+        except ImportError:
+            return None
+        return simdjson.loads
+    if name == 'json':
+        return _stdlib_loads
+    raise ValueError("Unknown JSON backend \"{}\"".format(name))
+
+
+def select(name=None):
+    """Select the decoder used by loads, returning the backend name
+
+    With no name the first installed backend of BACKENDS is used."""
+    global loads, backend
+    names = (name,) if name else BACKENDS
+    for n in names:
+        func = _load(n)
+        if func is not None:
+            loads, backend = func, n
+            return n
+    raise RuntimeError("JSON backend \"{}\" is not installed".format(name))
+
+
+loads = _stdlib_loads
+backend = 'json'
+try:
+    select(os.environ.get(ENV, None))
+except (RuntimeError, ValueError):
+    select()
@@ -0,0 +1,70 @@
+import sys
+import shutil
+import subprocess
+
+
+def _description(subdomain, uuid):
+    return 'py1password:{}:{}'.format(subdomain, uuid)
+
+
+def _keyctl(args, data=None):
+    return subprocess.run(['keyctl'] + args, shell=False,
+                          input=data,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+
+
+def available():
+    """Return True if the kernel keyring can be used"""
+    return sys.platform.startswith('linux') and \
+        shutil.which('keyctl') is not None
+
+
+def store(subdomain, uuid, passphrase, timeout, encoding='utf-8'):
+    """Store a passphrase in the session keyring
+
+    The key expires from the keyring after timeout seconds. Returns True
+    if the passphrase was stored."""
+    if not available():
+        return False
+
+    rtn = _keyctl(['padd', 'user', _description(subdomain, uuid), '@s'],
+                  data=passphrase.encode(encoding))
+    if rtn.returncode != 0:
+        return False
+
+    keyid = rtn.stdout.strip().decode(encoding)
+    rtn = _keyctl(['timeout', keyid, str(int(timeout))])
+    if rtn.returncode != 0:
+        # Never leave a passphrase behind without an expiry
+        _keyctl(['unlink', keyid, '@s'])
+        return False
+
+    return True
+
+
+def cached(subdomain, uuid):
+    """Return True if a passphrase is cached, without reading it"""
+    if not available():
+        return False
+
+    rtn = _keyctl(['search', '@s', 'user', _description(subdomain, uuid)])
+    return rtn.returncode == 0
+
+
+def fetch(subdomain, uuid, encoding='utf-8'):
+    """Fetch a passphrase from the session keyring
+
+    Returns None if the passphrase is not cached or has expired."""
+    if not available():
+        return None
+
+    rtn = _keyctl(['search', '@s', 'user', _description(subdomain, uuid)])
+    if rtn.returncode != 0:
+        return None
+
+    rtn = _keyctl(['pipe', rtn.stdout.strip().decode(encoding)])
+    if rtn.returncode != 0:
+        return None
+
+    return rtn.stdout.decode(encoding)
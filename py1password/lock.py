@@ -0,0 +1,66 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+
+
+class singleflight:
+    """Cross-process single-flight execution
+
+    The first process to call :meth:`run` for a given key does the work
+    while holding an exclusive lock and publishes its (JSON serializable)
+    result. Processes arriving while the work is in flight wait for the
+    lock and reuse the published result instead of repeating the work. If
+    the leader fails nothing is published and the next waiter does the
+    work itself."""
+
+    def __init__(self, path, key, max_age=60):
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        digest = hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+        base = os.path.join(path, 'flight-{}'.format(digest[:16]))
+        self._lockfile = base + '.lock'
+        self._resultfile = base + '.json'
+        self._max_age = max_age
+        self.waited = False
+
+    def _read(self, since):
+        try:
+            with open(self._resultfile, 'r') as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if result['time'] < since:
+            return None
+        if (time.time() - result['time']) > self._max_age:
+            return None
+
+        return result
+
+    def _write(self, value):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self._resultfile))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'time': time.time(), 'value': value}, f)
+        os.replace(tmp, self._resultfile)
+
+    def run(self, func, *args, **kwargs):
+        """Run func unless a concurrent process is already running it"""
+        fd = os.open(self._lockfile, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.waited = True
+                start = time.time()
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                result = self._read(start)
+                if result is not None:
+                    return result['value']
+
+            value = func(*args, **kwargs)
+            self._write(value)
+            return value
+        finally:
+            os.close(fd)
@@ -0,0 +1,145 @@
+import os
+import sys
+import grp
+import pwd
+import json
+import time
+import base64
+import socket
+import struct
+import threading
+import socketserver
+
+
+class MirrorError(RuntimeError):
+    """Error reported by the vault mirror"""
+    def __init__(self, message, kind=None):
+        super().__init__(message)
+        self.kind = kind
+
+
+def request(path, req, timeout=60):
+    """Send a request to a vault mirror and return the decoded reply"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(req).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            reply = json.loads(f.readline().decode('utf-8'))
+    finally:
+        sock.close()
+
+    if not reply['ok']:
+        raise MirrorError("Vault mirror error: {}".format(reply['error']),
+                          reply.get('type', None))
+
+    return base64.b64decode(reply['data'])
+
+
+def _peer_uid(sock):
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid, gid
+
+
+class _mirrorHandler(socketserver.StreamRequestHandler):
+    def _reply(self, reply):
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+    def handle(self):
+        uid, gid = _peer_uid(self.connection)
+        if not self.server.allowed(uid, gid):
+            self._reply({'ok': False, 'error': 'Permission denied'})
+            return
+
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        try:
+            data = self.server.lookup(json.loads(line.decode('utf-8')))
+        except Exception as e:
+            self._reply({'ok': False, 'error': str(e),
+                         'type': type(e).__name__})
+        else:
+            self._reply({'ok': True,
+                         'data': base64.b64encode(data).decode('ascii')})
+
+
+class vaultMirror(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Read-through mirror of a vault shared over a unix socket
+
+    One authenticated onepasswordSSH instance serves item, document and
+    passphrase lookups for every local user allowed to connect, so the
+    vault is listed and each item fetched once for the whole host. Access
+    is limited to the owner of the mirror and, if group is given, members
+    of that group (checked with SO_PEERCRED)."""
+    daemon_threads = True
+    # Room for many users' tools connecting at once
+    request_queue_size = 128
+
+    def __init__(self, op, path, group=None, list_ttl=300):
+        self._op = op
+        self._list_ttl = list_ttl
+        self._listed = time.time()
+        self._list_lock = threading.Lock()
+        self._gid = None
+        if group is not None:
+            self._gid = grp.getgrnam(group).gr_gid
+
+        if os.path.exists(path):
+            os.unlink(path)
+        umask = os.umask(0o177 if self._gid is None else 0o117)
+        try:
+            super().__init__(path, _mirrorHandler)
+        finally:
+            os.umask(umask)
+        if self._gid is not None:
+            os.chown(path, -1, self._gid)
+
+    def allowed(self, uid, gid):
+        """Check if the peer uid may use the mirror"""
+        if uid == os.getuid() or uid == 0:
+            return True
+        if self._gid is None:
+            return False
+        if gid == self._gid:
+            return True
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            return False
+        return self._gid in os.getgrouplist(name, gid)
+
+    def _list(self):
+        # Only one handler lists the vault, the others wait for it
+        with self._list_lock:
+            if (time.time() - self._listed) > self._list_ttl:
+                self._op._get_list('items')
+                self._listed = time.time()
+        return json.dumps(self._op._items).encode('utf-8')
+
+    def lookup(self, req):
+        """Answer a request from a client"""
+        if 'passphrase' in req:
+            return self._op.get_passphrase(req['passphrase']).encode('utf-8')
+
+        cmd = req['cmd']
+        if cmd == ['op', 'list', 'items']:
+            return self._list()
+        if cmd[:3] == ['op', 'get', 'item'] and len(cmd) == 4:
+            item = self._op.get_items([cmd[3]])[0]
+            return json.dumps(item).encode('utf-8')
+        if cmd[:3] == ['op', 'get', 'document'] and len(cmd) == 4:
+            return self._op.get_documents([cmd[3]])[0]
+
+        raise RuntimeError("Unsupported request {}".format(cmd))
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        if self._op._verbose:
+            print("Vault mirror stopped ....", file=sys.stderr)
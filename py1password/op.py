@@ -1,18 +1,178 @@
 import os
 import sys
-import json
+import time
+import atexit
+import tempfile
+import threading
+import contextlib
 import subprocess
+from . import ratelimit
+from . import mirror
+from . import tracing
+from . import jsonbackend
+from . import index
+from . import selector
+from . import diff
+from .store import itemstore
+from .cache import lrucache, negativecache, snapshotcache, latencystats
+
+# Messages from the op cli for lookups of items which do not exist
+_NOT_FOUND = (b"doesn't seem to be", b"isn't an item", b"isn't a document",
+              b"not found")
+
+# Messages from the op cli when the service can't be reached
+_UNAVAILABLE = (b"too many requests", b"connection refused", b"no such host",
+                b"network is unreachable", b"dial tcp", b"i/o timeout")
+
+# op commands whose output is kept for offline use
+_SNAPSHOT_CMDS = (['op', 'list'], ['op', 'get'])
+
+
+class NotFoundError(RuntimeError):
+    """The requested item does not exist in the vault"""
+    pass
+
+
+class DeadlineExceeded(RuntimeError):
+    """The time budget for the operation has run out"""
+    pass
+
+
+class OpUnavailable(RuntimeError):
+    """The op cli or the 1password service can't be reached"""
+    pass
+
+
+def default_cache_path():
+    """Return the directory used to keep local state"""
+    path = os.environ.get('XDG_CACHE_HOME', None)
+    if path is None:
+        path = os.path.join(os.environ['HOME'], '.cache')
+    return os.path.join(path, 'py1password')
+
+
+def open_index(subdomain='my', cache_path=None):
+    """Open the item index written by the last list of the vault
+
+    Returns None if there is no index, i.e. the vault has not been listed
+    with persistent_cache enabled."""
+    if cache_path is None:
+        cache_path = default_cache_path()
+    try:
+        return index.itemindex(
+            os.path.join(cache_path, '{}-index'.format(subdomain)))
+    except (OSError, ValueError):
+        return None
+
+
+def _call_kind(cmd):
+    """Name the kind of a subprocess call for latency records"""
+    if cmd[0] == 'op':
+        if cmd[1] == 'signin':
+            return 'op signin'
+        return ' '.join(cmd[:3])
+    return ' '.join([cmd[0]] + [arg for arg in cmd[1:]
+                                if arg.startswith('-')])
+
+
+def _emit(data, stdout=None):
+    """Return data, or write it to stdout if given"""
+    if stdout is None:
+        return data
+    stdout.write(data)
+    return None
 
 
 class onepassword:
+    """Client for the 1password cli
+
+    An instance may be shared between threads and reused for the life of
+    the process: re-authentication is serialised so that only one signin
+    happens when the session expires, the item list and its tag index are
+    replaced atomically, and the item caches are locked. Deadlines set
+    with the ``deadline`` argument of the public calls apply to the
+    calling thread only."""
+
     def __init__(self, subdomain='my', verbose=False, quiet=False,
-                 timeout=60, login_tries=5, encoding='utf-8'):
+                 timeout=60, login_tries=5, encoding='utf-8',
+                 cache_path=None, token_file=None, rate_limit=None,
+                 cache_size=4 * 1024 * 1024, cache_ttl=None,
+                 negative_ttl=30, persistent_cache=False, deadline=None,
+                 offline=False, max_stale=86400, mirror=None,
+                 item_store=False):
         self._subdomain = subdomain
         self._encoding = encoding
-        self._items = None
+        # The item list and its tag index, swapped together as one tuple
+        self._list = (None, dict())
+        self._list_lock = threading.Lock()
+        # Mapped index of the list, kept with persistent_cache
+        self._index = None
         self._timeout = timeout
         self._login_tries = login_tries
 
+        self._token_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+        # Absolute time (epoch) by which all work must be finished, either
+        # inherited from a parent process or deadline seconds from now
+        self._base_deadline = os.environ.get('OP_DEADLINE', None)
+        if self._base_deadline is not None:
+            self._base_deadline = float(self._base_deadline)
+        if deadline is not None:
+            self._base_deadline = self._min_deadline(time.time() + deadline)
+
+        if cache_path is None:
+            self._cache_path = default_cache_path()
+        else:
+            self._cache_path = cache_path
+
+        self._stats = {'op_calls': 0, 'op_time': 0.0, 'signins': 0,
+                       'ratelimit_waits': 0, 'ratelimit_time': 0.0,
+                       'offline_hits': 0, 'mirror_calls': 0}
+
+        # Latency of each kind of call, kept between runs for estimates
+        self._latency = latencystats(self._cache_file('latency.json'))
+        atexit.register(self._latency.save)
+
+        # In memory cache of items keyed by uuid
+        self._item_cache = lrucache(cache_size, cache_ttl)
+
+        # Record of lookups which found nothing
+        self._persistent_cache = persistent_cache
+        self._negative = negativecache(
+            negative_ttl,
+            self._cache_file('negative.json') if persistent_cache else None)
+
+        # Indexed copy of the vault overview shared between processes
+        self._store = None
+        if item_store:
+            self._store = itemstore(self._cache_file('items.sqlite'))
+
+        # Read through a host local vault mirror instead of running op
+        if mirror is None:
+            mirror = os.environ.get('OP_MIRROR_SOCKET', None)
+        self._mirror = mirror
+
+        # Serve from the last good snapshot when op can't be reached
+        self._offline = offline
+        self._max_stale = max_stale
+        self._degraded = False
+        self._degraded_lock = threading.Lock()
+        self._snapshot = None
+        if offline:
+            self._snapshot = snapshotcache(self._cache_file('snapshot'))
+
+        # Rate limit shared by all processes using the same cache path
+        if rate_limit is None:
+            rate_limit = os.environ.get('OP_RATE_LIMIT', None)
+        self._rate_limit = rate_limit
+        self._limiter = None
+        rate, burst = ratelimit.parse_rate(rate_limit)
+        if rate:
+            self._limiter = ratelimit.tokenbucket(
+                self._cache_file('ratelimit.json'), rate, burst)
+
         self._opkey = os.environ.get('OP_SESSION_{}'.format(self._subdomain))
         if self._opkey is not None:
             self._opkey = bytearray(self._opkey, self._encoding)
@@ -23,9 +183,21 @@ class onepassword:
         if quiet:
             self._verbose = 0
 
+        # Non-interactive (service account) authentication takes precedence
+
+        self._service_token = self._read_service_token(token_file)
+
         # If we haven't authenticated at the shell, authenticate
 
-        if self._opkey is not None:
+        if self._mirror is not None:
+            if self._verbose:
+                print("Using vault mirror \"{}\" ....".format(self._mirror),
+                      file=sys.stderr)
+        elif self._service_token is not None:
+            if self._verbose:
+                print("Using 1password service account ....",
+                      file=sys.stderr)
+        elif self._opkey is not None:
             if self._verbose:
                 print("Using previous 1password authentication ....",
                       file=sys.stderr)
@@ -34,49 +206,310 @@ class onepassword:
 
         self._get_list('items')
 
+    @property
+    def _items(self):
+        return self._list[0]
+
+    @property
+    def _tag_index(self):
+        return self._list[1]
+
     def _print(self, txt, col=70):
         print('{message:.<{width}}'.format(message=txt + ' ', width=col),
               end=' ', file=sys.stderr)
 
-    def _run_op(self, cmd):
-        """Run subprocess to talk to 1password"""
+    def _cache_file(self, name):
+        """Return the path of a state file, creating the cache dir"""
+        os.makedirs(self._cache_path, mode=0o700, exist_ok=True)
+        return os.path.join(self._cache_path,
+                            '{}-{}'.format(self._subdomain, name))
+
+    def _read_service_token(self, token_file=None):
+        """Read a service account token from a file or the environment"""
+        if token_file is None:
+            token_file = os.environ.get('OP_SERVICE_ACCOUNT_TOKEN_FILE', None)
+
+        if token_file is None:
+            return os.environ.get('OP_SERVICE_ACCOUNT_TOKEN', None)
+
+        if os.stat(token_file).st_mode & 0o077:
+            raise RuntimeError("Service account token file \"{}\" must not "
+                               "be accessible by group or others"
+                               .format(token_file))
+
+        with open(token_file, 'r') as f:
+            return f.read().strip()
+
+    def _op_env(self):
+        """Return the environment for the op cli"""
+        if self._service_token is None:
+            return None
+
+        env = os.environ.copy()
+        env['OP_SERVICE_ACCOUNT_TOKEN'] = self._service_token
+        return env
+
+    def stats(self):
+        """Return the instrumentation counters"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['cache_hits'] = self._item_cache.hits
+        stats['cache_misses'] = self._item_cache.misses
+        stats['cache_coalesced'] = self._item_cache.coalesced
+        stats['cache_hit_ratio'] = self._item_cache.hit_ratio()
+        return stats
+
+    def _count(self, key, value=1):
+        with self._stats_lock:
+            self._stats[key] += value
+
+    @property
+    def _deadline(self):
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return self._base_deadline
+        return deadline
+
+    def _min_deadline(self, deadline):
+        if self._deadline is None:
+            return deadline
+        return min(self._deadline, deadline)
+
+    @contextlib.contextmanager
+    def _budget(self, deadline=None, until=None):
+        """Limit the enclosed work in this thread
+
+        The work must finish within deadline seconds, or by the absolute
+        time until."""
+        if deadline is not None:
+            until = time.time() + deadline
+        if until is None:
+            yield
+            return
+
+        previous = getattr(self._local, 'deadline', None)
+        self._local.deadline = self._min_deadline(until)
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    def _remaining(self):
+        """Return the time left in the budget, raising if none is left"""
+        if self._deadline is None:
+            return None
+
+        remaining = self._deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded("Deadline exceeded")
+        return remaining
+
+    def _call_timeout(self):
+        remaining = self._remaining()
+        if remaining is None:
+            return self._timeout
+        if self._timeout is None:
+            return remaining
+        return min(self._timeout, remaining)
+
+    def _run(self, cmd, **kwargs):
+        """Run a subprocess within the timeout and remaining budget"""
+        try:
+            start = time.time()
+            rtn = subprocess.run(cmd, shell=False,
+                                 timeout=self._call_timeout(), **kwargs)
+            self._latency.record(_call_kind(cmd), time.time() - start)
+            return rtn
+        except subprocess.TimeoutExpired:
+            if self._deadline is not None and time.time() >= self._deadline:
+                raise DeadlineExceeded("Deadline exceeded running \"{}\""
+                                       .format(' '.join(cmd[:3])))
+            raise
+
+    def _throttle(self):
+        """Wait for the rate limiter before calling op"""
+        if self._limiter is None:
+            return
+
+        waited = self._limiter.acquire(self._deadline)
+        if waited is None:
+            raise DeadlineExceeded("Deadline exceeded waiting for the "
+                                   "rate limiter")
+        if waited > 0.001:
+            self._count('ratelimit_waits')
+            self._count('ratelimit_time', waited)
+            if self._verbose == 2:
+                print("Rate limited, queued for {:.3f}s ...."
+                      .format(waited), file=sys.stderr)
+
+    @tracing.traced()
+    def _run_op(self, cmd, stdout=None):
+        """Run subprocess to talk to 1password
+
+        If stdout (a binary file) is given the output is written to it
+        rather than returned. In offline mode output is served from the
+        snapshot while op is unavailable, and every good output refreshes
+        the snapshot."""
+        tracing.annotate(cmd=_call_kind(cmd))
+        if self._mirror is not None:
+            return _emit(self._mirror_call({'cmd': cmd}), stdout)
+
+        if self._snapshot is None:
+            return self._op_call(cmd, stdout)
+
+        key = ' '.join(cmd)
+        if not self._degraded:
+            try:
+                out = self._op_call(cmd, stdout)
+            except OpUnavailable as e:
+                self._set_degraded(e)
+            else:
+                if cmd[:2] in _SNAPSHOT_CMDS:
+                    if stdout is None:
+                        self._snapshot.store(key, out)
+                    else:
+                        self._snapshot.store_file(key, stdout)
+                return out
+
+        cached = self._snapshot.load(key, self._max_stale)
+        if cached is None:
+            raise OpUnavailable("1password unavailable and no cached copy "
+                                "of \"{}\"".format(key))
+        self._count('offline_hits')
+        if stdout is not None:
+            # Drop what a failed streamed call wrote before the snapshot
+            stdout.seek(0)
+            stdout.truncate()
+        return _emit(cached[0], stdout)
+
+    def _mirror_call(self, req):
+        """Answer a request from the vault mirror"""
+        start = time.time()
+        try:
+            return mirror.request(self._mirror, req, self._call_timeout())
+        except mirror.MirrorError as e:
+            if e.kind == 'NotFoundError':
+                raise NotFoundError(str(e))
+            raise
+        finally:
+            self._count('mirror_calls')
+            self._count('op_time', time.time() - start)
+
+    def _set_degraded(self, err):
+        """Switch to serving from the snapshot and start refreshing"""
+        with self._degraded_lock:
+            if self._degraded:
+                return
+            self._degraded = True
+
+        if self._verbose:
+            print("1password unavailable ({}), running degraded from "
+                  "cached data ....".format(err), file=sys.stderr)
+
+        thread = threading.Thread(target=self._refresh_offline, daemon=True)
+        thread.start()
+
+    def _refresh_offline(self, interval=30):
+        """Background retry of op until it responds again"""
+        while True:
+            time.sleep(interval)
+            try:
+                out = self._op_call(['op', 'list', 'items'])
+            except Exception:
+                continue
+
+            self._snapshot.store('op list items', out)
+            self._index_list(out)
+            self._degraded = False
+            if self._verbose:
+                print("1password available again ....", file=sys.stderr)
+            return
+
+    def _op_call(self, cmd, stdout=None):
+        """Run the op cli, signing in again if needed"""
 
         rtncode = 127
         while(rtncode != 0):
-            rtn = subprocess.run(cmd, shell=False,
-                                 timeout=self._timeout,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 input=self._opkey)
+            self._throttle()
+            start = time.time()
+            opkey = self._opkey
+            if stdout is not None:
+                # Discard anything written by a failed attempt
+                stdout.seek(0)
+                stdout.truncate()
+            try:
+                rtn = self._run(cmd, env=self._op_env(),
+                                stdout=stdout or subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                input=opkey)
+            except (subprocess.TimeoutExpired, FileNotFoundError) as e:
+                if self._offline:
+                    raise OpUnavailable(str(e))
+                raise
+            self._count('op_calls')
+            self._count('op_time', time.time() - start)
             if (self._verbose == 2) and (rtn.stderr != b''):
                 print(rtn.stderr.decode(self._encoding), end='',
                       file=sys.stderr)
             rtncode = rtn.returncode
+            stderr = rtn.stderr.lower()
+            if rtncode != 0 and self._offline and \
+                    any(m in stderr for m in _UNAVAILABLE):
+                raise OpUnavailable(rtn.stderr.decode(self._encoding).strip())
+            if rtncode != 0 and b'too many requests' in stderr:
+                # Server side rate limit, back off rather than sign in
+                if self._verbose == 2:
+                    print("1password rate limit hit ....", file=sys.stderr)
+                time.sleep(min(1, self._remaining() or 1))
+                continue
+            if rtncode != 0 and any(m in stderr for m in _NOT_FOUND):
+                raise NotFoundError("Unable to find \"{}\" in vault"
+                                    .format(cmd[-1]))
             if rtncode != 0:
                 if self._verbose == 2:
                     print("1password cli failed (err={}) ...." .format(
                         rtn.returncode), file=sys.stderr)
-                print("Authenticating with 1password ....",
-                      file=sys.stderr)
-                self._get_token()
+                self._refresh_token(opkey)
 
         return rtn.stdout
 
+    def _refresh_token(self, failed):
+        """Sign in again unless another thread already replaced failed"""
+        with self._token_lock:
+            if self._opkey is not failed:
+                return
+            print("Authenticating with 1password ....", file=sys.stderr)
+            self._get_token()
+
+    @tracing.traced()
     def _get_token(self):
         """Get a token from 1password"""
 
+        if self._service_token is not None:
+            raise RuntimeError("1password service account was rejected")
+
         cmd = ['op', 'signin', self._subdomain, '--output=raw']
 
         # copy the env and remove the key
         env = os.environ.copy()
         env.pop('OP_SESSION_{}'.format(self._subdomain), None)
 
+        # In offline mode an unreachable service must be told apart from
+        # a failed login, so the snapshot can be served instead
+        kwargs = dict()
+        if self._offline:
+            kwargs['stderr'] = subprocess.PIPE
+
         # Now attempt login
         tries = self._login_tries
         while tries:
-            rtn = subprocess.run(cmd, shell=False,
-                                 timeout=self._timeout,
-                                 stdout=subprocess.PIPE)
+            self._count('signins')
+            try:
+                rtn = self._run(cmd, stdout=subprocess.PIPE, **kwargs)
+            except (subprocess.TimeoutExpired, FileNotFoundError) as e:
+                if self._offline:
+                    raise OpUnavailable(str(e))
+                raise
             if rtn.returncode == 0:
                 # We have a login
                 key = rtn.stdout
@@ -85,6 +518,12 @@ class onepassword:
                 self._opkey = rtn.stdout.lstrip().rstrip()
                 return
 
+            if self._offline:
+                stderr = rtn.stderr.decode(self._encoding)
+                if any(m in rtn.stderr.lower() for m in _UNAVAILABLE):
+                    raise OpUnavailable(stderr.strip())
+                print(stderr, end='', file=sys.stderr)
+
             tries -= 1
 
         # We should not get here
@@ -95,38 +534,158 @@ class onepassword:
         """List all items in the vault"""
         cmd = ['op', 'list', kind]
         p = self._run_op(cmd)
+        self._index_list(p)
 
-        # Now parse JSON
+    def _index_list(self, p):
+        """Parse the item list and rebuild the tag index"""
+        items = jsonbackend.loads(p)
+        tags = dict()
+        for obj in items:
+            for tag in obj['overview'].get('tags', []):
+                tags.setdefault(tag, list()).append(obj['uuid'])
 
-        self._items = json.loads(p)
+        with self._list_lock:
+            # Drop cached lookups of items changed since the last list
+            if self._items is not None:
+                delta = diff.diff(self._items, items)
+                for uuid in delta['modified'] + delta['removed']:
+                    self._item_cache.discard(uuid)
+                for uuid in delta['added']:
+                    if 'uuid:' + uuid in self._negative:
+                        self._negative.discard('uuid:' + uuid)
+
+            self._list = (items, tags)
+            if self._store is not None:
+                self._store.update_list(items)
+            if self._persistent_cache:
+                index.write(self._cache_file('index'), items)
+                self._index = open_index(self._subdomain, self._cache_path)
 
     def get_items(self, uuids):
         """Get Item from the vault based on uuid"""
 
         op = list()
         for uuid in uuids:
-            cmd = ['op', 'get', 'item', uuid]
-            p = self._run_op(cmd)
-            op.append(json.loads(p))
+            op.append(self._item_cache.get(uuid,
+                                           lambda: self._fetch_item(uuid)))
 
         return op
 
+    def _fetch_missing(self, cmd, uuid, stdout=None):
+        """Run op for a uuid lookup, remembering uuids which don't exist"""
+        if 'uuid:' + uuid in self._negative:
+            raise NotFoundError("Unable to find \"{}\" in vault (cached)"
+                                .format(uuid))
+        try:
+            return self._run_op(cmd, stdout)
+        except NotFoundError:
+            self._negative.add('uuid:' + uuid)
+            raise
+
+    def _fetch_item(self, uuid):
+        p = self._fetch_missing(['op', 'get', 'item', uuid], uuid)
+        item = jsonbackend.loads(p)
+        if self._store is not None:
+            self._store.update_item(item)
+        return item, len(p)
+
     def get_documents(self, uuids):
         """Get a document from the vault"""
+        return list(self.iter_documents(uuids))
 
-        op = list()
+    def iter_documents(self, uuids):
+        """Get documents from the vault one at a time"""
         for uuid in uuids:
             cmd = ['op', 'get', 'document', uuid]
-            p = self._run_op(cmd)
-            op.append(p)
+            yield self._fetch_missing(cmd, uuid)
 
-        return op
+    def save_document(self, uuid, filename, mode=0o600):
+        """Save a document from the vault to filename
+
+        The op cli writes straight into a temporary file next to filename,
+        which then replaces it, so the document is never held in memory
+        and filename is never left partly written."""
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                os.fchmod(f.fileno(), mode)
+                self._fetch_missing(['op', 'get', 'document', uuid], uuid, f)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _find_title(self, title):
+        """Return the uuids of the items with the given title
+
+        The mapped index is searched when there is one, rather than
+        scanning the decoded item list."""
+        idx = self._index
+        if idx is not None:
+            return idx.find_title(title)
+        return [obj['uuid'] for obj in self._items
+                if obj['overview'].get('title') == title]
 
     def find_items_tag(self, tag):
         """Find an item based on entry to """
 
-        objs = [obj for obj in self._items if
-                any([t == tag for t in obj['overview'].get('tags', [])])]
+        uuids = list(self._tag_index.get(tag, []))
+
+        if not uuids:
+            self._negative.add('tag:' + tag)
+        elif 'tag:' + tag in self._negative:
+            self._negative.discard('tag:' + tag)
+
+        return uuids
+
+    def diff_items(self, old):
+        """Compare an earlier item list with the current one
+
+        Returns a dict of the uuids added, removed and modified since old
+        matching items by uuid and version."""
+        return diff.diff(old, self._items)
+
+    def extract(self, items, selectors):
+        """Extract values from items with field selectors
+
+        selectors maps names to selectors such as
+        ``section[*].field[t=KeyName,k=string].v``; items may be items or
+        uuids. Returns a dict of the first match (or None) of each
+        selector for every item."""
+        items = [self.get_items([item])[0] if isinstance(item, str) else item
+                 for item in items]
+        return selector.extract(items, selectors)
+
+    def find_items(self, title=None, category=None, vault=None, tag=None,
+                   updated_since=None, field=None, value=None):
+        """Find the uuids of items matching all of the given criteria
+
+        Searching on field values needs the item store, which only knows
+        the fields of items fetched since it was enabled."""
+        if self._store is not None:
+            return self._store.find(title, category, vault, tag,
+                                    updated_since, field, value)
+
+        if field is not None or value is not None:
+            raise RuntimeError("Searching on fields needs the item store")
+
+        uuids = list()
+        for obj in sorted(self._items,
+                          key=lambda obj: obj['overview'].get('title', '')):
+            overview = obj['overview']
+            if title is not None and \
+                    overview.get('title', '').lower() != title.lower():
+                continue
+            if category is not None and obj.get('templateUuid') != category:
+                continue
+            if vault is not None and obj.get('vaultUuid') != vault:
+                continue
+            if tag is not None and tag not in overview.get('tags', []):
+                continue
+            if updated_since is not None and \
+                    obj.get('updatedAt', '') < updated_since:
+                continue
+            uuids.append(obj['uuid'])
 
-        # print(json.dumps(objs, sort_keys=True, indent=4))
-        return [obj['uuid'] for obj in objs]
+        return uuids
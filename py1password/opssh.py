@@ -1,13 +1,39 @@
 import os
 import sys
+import json
+import atexit
+import time
+import queue
+import tempfile
+import threading
 import subprocess
 from .op import onepassword
+from . import keyring
+from .zygote import askpassZygote
+from . import profiling
+from . import tracing
+
+# Latency guesses (seconds) for calls never timed on this host
+_DEFAULT_LATENCY = {'op list items': 1.0, 'op get item': 0.5,
+                    'op get document': 0.5, 'op signin': 2.0,
+                    'ssh-add': 0.05, 'ssh-add -D': 0.05,
+                    'ssh-keygen -y -f': 0.05}
+
+# Where the key name, passphrase and file name are kept in items
+KEY_SELECTORS = {'name': 'section[*].field[t=KeyName,k=string].v',
+                 'passphrase': 'section[*].field[t=Passphrase,'
+                               'k=concealed].v',
+                 'filename': 'details.documentAttributes.fileName'}
 
 
 class onepasswordSSH(onepassword):
-    def __init__(self, *args, keys_path=None, **kwargs):
+    def __init__(self, *args, keys_path=None, keyring_timeout=None,
+                 zygote=False, **kwargs):
         super().__init__(*args, **kwargs)
 
+        self._keyring_timeout = keyring_timeout
+        self._mru_lock = threading.Lock()
+
         if keys_path is None:
             self._keys_path = os.path.join(os.environ['HOME'], ".ssh")
         else:
@@ -17,8 +43,18 @@ class onepasswordSSH(onepassword):
             print("Using SSH path \"{}\" ....".format(self._keys_path),
                   file=sys.stderr)
 
-    def get_keys_info(self):
+        # Fork the askpass zygote now, before any threads are started
+        self._zygote = None
+        if zygote:
+            self._zygote = askpassZygote(self, self._timeout)
+            atexit.register(self._zygote.close)
+
+    def get_keys_info(self, deadline=None):
         """Get the SSH keys from the vault"""
+        with self._budget(deadline):
+            return self._get_keys_info()
+
+    def _get_keys_info(self):
         uuids = self.find_items_tag('SSH_KEY')
         if not len(uuids):
             raise RuntimeError("Unable to find SSH keys in database")
@@ -30,71 +66,148 @@ class onepasswordSSH(onepassword):
 
         return keys
 
+    def find_key_uuid(self, key_name):
+        """Find the uuid of a SSH key given its name
+
+        Items are fetched one at a time, stopping at the first match, so
+        only as much of the vault is read as needed."""
+        for uuid in self.find_items_tag('SSH_KEY'):
+            name, info = self._get_key_info(uuid)
+            if name == key_name:
+                return uuid
+
+        return None
+
     def get_passphrase(self, uuid):
         """Get the pasphrase of a SSH key given UUID"""
-        name, info = self._get_key_info(uuid)
+        if self._keyring_timeout:
+            passphrase = keyring.fetch(self._subdomain, uuid, self._encoding)
+            if passphrase is not None:
+                return passphrase
+        if self._mirror is not None:
+            return self._mirror_call({'passphrase': uuid}).decode(
+                self._encoding)
+        name, info = self._fetch_key_info(uuid)
         return info['passphrase']
 
-    def _get_key_info(self, uuids):
-        items = self.get_items([uuids])
-
-        for item in items:
-            fields = [sect['fields']
-                      for sect in item['details']['sections']
-                      if 'fields' in sect]
-
-            if len(fields) != 1:
-                raise RuntimeError("More than one fields in key.")
-            fields = fields[0]
-
-            name = None
-            passphrase = None
-            for field in fields:
-                if (field['t'] == 'KeyName') and \
-                   (field['k'] == 'string'):
-                    name = field['v']
-                if (field['t'] == 'Passphrase') and \
-                   (field['k'] == 'concealed'):
-                    passphrase = field['v']
-
-            if (name is not None) and (passphrase is not None):
-                if self._verbose == 2:
-                    self._print("SSH key uuid=\"{}\" name=\"{}\""
-                                .format(item['uuid'], name))
-                    print("FOUND", file=sys.stderr)
-
-                keys = {'passphrase': passphrase, 'uuid': item['uuid']}
-            else:
-                if self._verbose == 2:
-                    print("ERROR", file=sys.stderr)
+    def _cached_key_info(self, uuid):
+        """Return the name and info of a key from the keyring, or None
+
+        The name comes from the recorded key usage, so only keys which
+        were added to the agent before are found."""
+        names = [name for name, vals in self._read_mru().items()
+                 if vals['uuid'] == uuid]
+        if not names:
+            return None
+
+        passphrase = keyring.fetch(self._subdomain, uuid, self._encoding)
+        if passphrase is None:
+            return None
+
+        if self._verbose == 2:
+            self._print("SSH key uuid=\"{}\" name=\"{}\""
+                        .format(uuid, names[0]))
+            print("KEYRING", file=sys.stderr)
+        return names[0], {'passphrase': passphrase, 'uuid': uuid}
+
+    def _get_key_info(self, uuid):
+        if self._keyring_timeout:
+            cached = self._cached_key_info(uuid)
+            if cached is not None:
+                return cached
+        return self._fetch_key_info(uuid)
+
+    def _fetch_key_info(self, uuid):
+        item = self.get_items([uuid])[0]
+        info = self.extract([item], KEY_SELECTORS)[0]
+        name = info['name']
+        passphrase = info['passphrase']
+
+        if (name is None) or (passphrase is None):
+            if self._verbose == 2:
+                print("ERROR", file=sys.stderr)
+            raise RuntimeError("Item \"{}\" is not a SSH key".format(uuid))
+
+        if self._verbose == 2:
+            self._print("SSH key uuid=\"{}\" name=\"{}\""
+                        .format(item['uuid'], name))
+            print("FOUND", file=sys.stderr)
+
+        keys = {'passphrase': passphrase, 'uuid': item['uuid']}
+        if self._keyring_timeout:
+            keyring.store(self._subdomain, item['uuid'], passphrase,
+                          self._keyring_timeout, self._encoding)
 
         return name, keys
 
-    def _ssh_askpass(self, cmd, uuid):
-        """Run a command with the askpass setup for vault"""
+    @tracing.traced()
+    def _ssh_askpass(self, cmd, uuid, passphrase=None):
+        """Run a command with the askpass setup for vault
+
+        If the askpass zygote is running it answers the prompt, with the
+        passphrase registered beforehand if it is already known. Otherwise
+        a known passphrase is handed to op-askpass through an inherited
+        pipe, so the child neither needs the session token nor has to go
+        back to the vault."""
         env = os.environ.copy()
+        # Credentials are only passed on when the handoff needs them
+        env.pop('OP_SESSION_{}'.format(self._subdomain), None)
+        env.pop('OP_SERVICE_ACCOUNT_TOKEN', None)
         env['SSH_ASKPASS'] = 'op-askpass'
         env['DISPLAY'] = 'foo'
-        env['OP_SESSION_{}'.format(self._subdomain)] = \
-            self._opkey.decode(self._encoding)
         env['OP_SESSION_SUBDOMAIN'] = self._subdomain
         env['OP_SESSION_TIMEOUT'] = str(self._timeout)
         env['SSH_KEY_UUID'] = uuid
-
-        rtn = subprocess.run(cmd, shell=False, env=env,
-                             timeout=self._timeout,
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+        if self._rate_limit is not None:
+            env['OP_RATE_LIMIT'] = str(self._rate_limit)
+        if self._keyring_timeout:
+            env['OP_KEYRING_TIMEOUT'] = str(self._keyring_timeout)
+        if self._deadline is not None:
+            env['OP_DEADLINE'] = repr(self._deadline)
+        if profiling.current() is not None:
+            env[profiling.ENV] = profiling.current()
+        tracing.child_env(env)
+
+        pass_fds = ()
+        if self._zygote is not None and (
+                passphrase is None or
+                self._zygote.register(uuid, passphrase)):
+            env['SSH_ASKPASS'] = self._zygote.shim
+        elif passphrase is not None:
+            rfd, wfd = os.pipe()
+            os.write(wfd, passphrase.encode(self._encoding))
+            os.close(wfd)
+            env['OP_ASKPASS_FD'] = str(rfd)
+            pass_fds = (rfd,)
+        elif self._mirror is not None:
+            env['OP_MIRROR_SOCKET'] = self._mirror
+        elif self._service_token is not None:
+            env['OP_SERVICE_ACCOUNT_TOKEN'] = self._service_token
+        else:
+            env['OP_SESSION_{}'.format(self._subdomain)] = \
+                self._opkey.decode(self._encoding)
+
+        try:
+            rtn = self._run(cmd, env=env,
+                            pass_fds=pass_fds,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+        finally:
+            for fd in pass_fds:
+                os.close(fd)
         return rtn
 
-    def _ssh_add(self, uuid, key):
+    @tracing.traced()
+    def _ssh_add(self, uuid, key, passphrase=None):
         if self._verbose:
             self._print("Adding key \"{}\" to ssh-agent".format(key))
 
         cmd = ['ssh-add', os.path.join(self._keys_path, key)]
 
-        rtn = self._ssh_askpass(cmd, uuid)
+        rtn = self._ssh_askpass(cmd, uuid, passphrase)
+        if rtn.returncode == 0:
+            self._record_used(key, uuid)
 
         if self._verbose:
             if rtn.returncode:
@@ -111,10 +224,9 @@ class onepasswordSSH(onepassword):
             self._print("Calling ssh-add to delete current keys")
 
         cmd = ['ssh-add', '-D']
-        rtn = subprocess.run(cmd, shell=False, timeout=self._timeout,
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+        rtn = self._run(cmd, stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
         if self._verbose:
             if rtn.returncode:
                 print("FAILED.", file=sys.stderr)
@@ -128,20 +240,213 @@ class onepasswordSSH(onepassword):
 
         return False
 
-    def add_keys_to_agent(self, keys=None, delete=False):
-        """Add keys to ssh agent"""
-        _keys = self.get_keys_info()
+    def _read_mru(self):
+        """Read the locally recorded key usage"""
+        try:
+            with open(self._cache_file('mru.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _record_used(self, name, uuid):
+        """Record that a key was added to the agent"""
+        with self._mru_lock:
+            mru = self._read_mru()
+            mru[name] = {'uuid': uuid, 'used': time.time()}
+
+            filename = self._cache_file('mru.json')
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(mru, f)
+            os.replace(tmp, filename)
+
+    def _resolve_key_names(self, names, uuids):
+        """Map key names to uuids without fetching items
+
+        Names are looked up in the locally recorded key usage and then
+        in the item titles. Names which can't be resolved are left out."""
+        wanted = set(uuids)
+        mru = self._read_mru()
+
+        resolved = dict()
+        for name in names:
+            if name in mru and mru[name]['uuid'] in wanted:
+                resolved[name] = mru[name]['uuid']
+                continue
+            for uuid in self._find_title(name):
+                if uuid in wanted:
+                    resolved[name] = uuid
+                    break
+        return resolved
+
+    def _key_order(self, uuids, priority=None):
+        """Order uuids so priority and recently used keys come first"""
+        rank = dict()
+        for name, vals in self._read_mru().items():
+            rank[vals['uuid']] = (1, -vals['used'])
+
+        if priority is not None:
+            resolved = self._resolve_key_names(priority, uuids)
+            for n, name in enumerate(priority):
+                if name in resolved:
+                    rank[resolved[name]] = (0, n)
+                elif self._verbose:
+                    print("Unable to resolve priority key \"{}\", priority "
+                          "not applied ....".format(name), file=sys.stderr)
+
+        return sorted(uuids, key=lambda uuid: rank.get(uuid, (2, 0)))
+
+    def _fetch_keys_info(self, uuids, keys, out, until, span):
+        """Producer putting (name, info) into out as items arrive"""
+        wanted = None if keys is None else set(keys)
+        try:
+            with self._budget(until=until), \
+                    tracing.span('fetch_keys_info', parent=span):
+                self._put_keys_info(uuids, wanted, out)
+        except Exception as e:
+            out.put(e)
+        out.put(None)
+
+    def _put_keys_info(self, uuids, wanted, out):
+        for uuid in uuids:
+            name, info = self._get_key_info(uuid)
+            if wanted is None:
+                out.put((name, info))
+            elif name in wanted:
+                out.put((name, info))
+                wanted.discard(name)
+                if not wanted:
+                    break
+
+        for name in wanted or ():
+            self._negative.add('key:SSH_KEY:' + name)
+            if self._verbose:
+                print("Unable to find key \"{}\" in vault ...."
+                      .format(name), file=sys.stderr)
+
+    @tracing.traced()
+    def add_keys_to_agent(self, keys=None, delete=False, priority=None,
+                          deadline=None):
+        """Add keys to ssh agent
+
+        Items are fetched in a background thread and each key is added to
+        the agent as soon as its item arrives. Keys named in priority, and
+        then the most recently used keys, are fetched first. If deadline is
+        given the whole operation must finish within deadline seconds."""
+        with self._budget(deadline):
+            self._add_keys_to_agent(keys, delete, priority)
+
+    def _add_keys_to_agent(self, keys, delete, priority):
+        uuids = self.find_items_tag('SSH_KEY')
+        if not len(uuids):
+            raise RuntimeError("Unable to find SSH keys in database")
+
+        uuids = self._key_order(uuids, priority)
+
+        fetched = queue.Queue()
+        producer = threading.Thread(target=self._fetch_keys_info,
+                                    args=(uuids, keys, fetched,
+                                          self._deadline, tracing.current()),
+                                    daemon=True)
+        producer.start()
 
         if delete:
             self.agent_delete_keys()
 
+        while True:
+            item = fetched.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            name, vals = item
+            self._ssh_add(vals['uuid'], name, vals['passphrase'])
+
+        producer.join()
+
+    def _plan_items(self, uuids, calls, cached, keys=False):
+        """Count the item fetches, or the cache entries sparing them
+
+        With keys, passphrases left in the keyring by earlier runs count
+        as hits for the keys the recorded key usage can name."""
+        named = set()
+        if keys and self._keyring_timeout:
+            named = set(vals['uuid'] for vals in self._read_mru().values())
+        for uuid in uuids:
+            if uuid in self._item_cache or 'uuid:' + uuid in self._negative:
+                cached.append(uuid)
+            elif uuid in named and keyring.cached(self._subdomain, uuid):
+                cached.append(uuid)
+            else:
+                calls['op get item'] += 1
+
+    def plan(self, operation='unlock', keys=None, delete=False,
+             overwrite=False):
+        """Report the calls an operation would make without making them
+
+        operation is 'unlock' (add_keys_to_agent) or 'getkey'
+        (save_ssh_keys). Tags and key names are resolved from the item
+        list and the locally recorded key usage; no item, document or
+        passphrase is fetched. Counts for key names which can't be
+        resolved locally are upper bounds. cache_hits counts the items
+        served from the caches, including what earlier runs left in the
+        persistent negative cache and the keyring. The estimated time uses
+        the latencies recorded on this host."""
+        calls = dict((kind, 0) for kind in _DEFAULT_LATENCY)
+        cached = list()
+        unresolved = list()
+
+        key_uuids = self.find_items_tag('SSH_KEY')
         if keys is None:
-            for name, vals in _keys.items():
-                self._ssh_add(vals['uuid'], name)
+            targets = list(key_uuids)
+        else:
+            resolved = self._resolve_key_names(keys, key_uuids)
+            missing = 'key:{}:'.format(
+                'SSH_KEY_FILE' if operation == 'getkey' else 'SSH_KEY')
+            targets = list()
+            for name in keys:
+                if missing + name in self._negative:
+                    continue
+                if name in resolved:
+                    targets.append(resolved[name])
+                else:
+                    unresolved.append(name)
+            if unresolved:
+                # Items are fetched until every name is found
+                targets = list(key_uuids)
+
+        if operation == 'unlock':
+            self._plan_items(targets, calls, cached, keys=True)
+            if delete:
+                calls['ssh-add -D'] += 1
+            calls['ssh-add'] += len(keys) if keys is not None \
+                else len(targets)
+        elif operation == 'getkey':
+            file_uuids = self.find_items_tag('SSH_KEY_FILE')
+            self._plan_items(file_uuids, calls, cached)
+            self._plan_items(key_uuids, calls, cached, keys=True)
+            if keys is None:
+                calls['op get document'] += len(file_uuids)
+                calls['ssh-keygen -y -f'] += len(file_uuids)
+            for name in keys or ():
+                # Key files are assumed to be named after the key
+                path = os.path.join(self._keys_path, name)
+                if overwrite or not os.path.isfile(path):
+                    calls['op get document'] += 1
+                if overwrite or not os.path.isfile(path + '.pub'):
+                    calls['ssh-keygen -y -f'] += 1
         else:
-            for name, vals in _keys.items():
-                if name in keys:
-                    self._ssh_add(vals['uuid'], name)
+            raise ValueError("Unknown operation \"{}\"".format(operation))
+
+        estimate = sum(n * self._latency.estimate(kind,
+                                                  _DEFAULT_LATENCY[kind])
+                       for kind, n in calls.items())
+
+        return {'operation': operation,
+                'calls': dict((k, v) for k, v in calls.items() if v),
+                'cache_hits': len(cached),
+                'unresolved_keys': unresolved,
+                'estimated_time': round(estimate, 3)}
 
     def get_private_keys(self):
         """Get the ssh private key files"""
@@ -149,38 +454,25 @@ class onepasswordSSH(onepassword):
         if not len(uuids):
             raise RuntimeError("Unable to find SSH keys in database")
 
-        items = self.get_items(uuids)
         keys = dict()
-        for item in items:
-            if 'details' not in item:
-                continue
-            if 'sections' not in item['details']:
+        for uuid, info in zip(uuids, self.extract(uuids, KEY_SELECTORS)):
+            if info['filename'] is None:
                 continue
-            fields = [sect['fields']
-                      for sect in item['details']['sections']
-                      if 'fields' in sect]
-
-            name = None
-            for field in fields:
-                if len(field) != 1:
-                    raise RuntimeError("Error parsing fields, expected "
-                                       "only one")
-                field = field[0]
-                if (field['t'] == 'KeyName') and (field['k'] == 'string'):
-                    name = field['v']
-
-            keys[name] = {'uuid': item['uuid'],
-                          'filename': item['details']
-                                          ['documentAttributes']
-                                          ['fileName']}
+            keys[info['name']] = {'uuid': uuid,
+                                  'filename': info['filename']}
 
         return keys
         # return self.get_documents([keys[key_id]['uuid']])
 
-    def save_ssh_keys(self, key_names=None, overwrite=False):
+    @tracing.traced()
+    def save_ssh_keys(self, key_names=None, overwrite=False, deadline=None):
         """Save the private key to a file"""
+        with self._budget(deadline):
+            self._save_ssh_keys(key_names, overwrite)
+
+    def _save_ssh_keys(self, key_names, overwrite):
         private_keys = self.get_private_keys()
-        public_keys = self.get_keys_info()
+        public_keys = self._get_keys_info()
 
         # If none get all keys found
         if key_names is None:
@@ -190,6 +482,7 @@ class onepasswordSSH(onepassword):
             _public_key = True
 
             if key_id not in private_keys:
+                self._negative.add('key:SSH_KEY_FILE:' + key_id)
                 raise RuntimeError("Unable to find private key \"{}\" in vault"
                                    .format(key_id))
             if key_id not in public_keys:
@@ -215,16 +508,12 @@ class onepasswordSSH(onepassword):
                                 .format(os.path.basename(private_filename)))
                     print("FAILED", file=sys.stderr)
             else:
-                _data = self.get_documents([private_keys[key_id]['uuid']])[0]
-
                 if self._verbose:
                     self._print("Writing private key \"{}\""
                                 .format(os.path.basename(private_filename)))
 
-                with open(os.open(private_filename,
-                                  os.O_CREAT | os.O_WRONLY,
-                                  0o600), 'wb') as file:
-                    file.write(_data)
+                self.save_document(private_keys[key_id]['uuid'],
+                                   private_filename, 0o600)
                 if self._verbose:
                     print("Done.", file=sys.stderr)
 
@@ -238,7 +527,8 @@ class onepasswordSSH(onepassword):
                     print("FAILED", file=sys.stderr)
                 else:
                     cmd = ['ssh-keygen', '-y', '-f', private_filename]
-                    rtn = self._ssh_askpass(cmd, public_keys[key_id]['uuid'])
+                    rtn = self._ssh_askpass(cmd, public_keys[key_id]['uuid'],
+                                            public_keys[key_id]['passphrase'])
                     if rtn.returncode == 0:
                         if self._verbose:
                             self._print("Writing public  key \"{}\""
@@ -0,0 +1,79 @@
+import os
+import sys
+import glob
+import pstats
+import cProfile
+import threading
+
+# Askpass children dump their profile next to the parent's when set
+ENV = 'OP_PROFILE'
+
+_current = None
+
+
+def current():
+    """Return the profile file of the running profiled call, if any"""
+    return _current
+
+
+class _threadProfiles:
+    """Start a profile in every thread started while installed"""
+
+    def __init__(self):
+        self.profiles = list()
+        self._lock = threading.Lock()
+        threading.setprofile(self._start)
+
+    def _start(self, frame, event, arg):
+        prof = cProfile.Profile()
+        try:
+            # Replaces this hook for the rest of the thread
+            prof.enable()
+        except ValueError:
+            # The profile of the run already covers every thread
+            sys.setprofile(None)
+            return
+        with self._lock:
+            self.profiles.append(prof)
+
+    def stop(self):
+        threading.setprofile(None)
+        with self._lock:
+            profiles, self.profiles = self.profiles, list()
+        return profiles
+
+
+def run(filename, func, *args, **kwargs):
+    """Run func under cProfile, dumping pstats to filename
+
+    Threads started by func, and askpass children of the run, are
+    profiled too and merged in, giving a single profile of the whole
+    operation."""
+    global _current
+    _current = filename
+    for stale in glob.glob(glob.escape(filename) + '.askpass.*'):
+        os.unlink(stale)
+
+    threads = _threadProfiles()
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(func, *args, **kwargs)
+    finally:
+        _current = None
+        stats = pstats.Stats(prof, *threads.stop())
+        for child in glob.glob(glob.escape(filename) + '.askpass.*'):
+            try:
+                stats.add(child)
+            except (OSError, EOFError, TypeError, ValueError):
+                pass
+            os.unlink(child)
+        stats.dump_stats(filename)
+
+
+def run_child(func):
+    """Profile an askpass child, dumping for the parent to merge"""
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(func)
+    finally:
+        prof.dump_stats('{}.askpass.{}'.format(os.environ[ENV], os.getpid()))
@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import fcntl
+
+
+def parse_rate(spec):
+    """Parse a rate limit given as ``rate[:burst]``"""
+    if spec is None:
+        return None, None
+    parts = str(spec).split(':')
+    rate = float(parts[0])
+    burst = float(parts[1]) if len(parts) > 1 else max(rate, 1.0)
+    return rate, burst
+
+
+class tokenbucket:
+    """Token bucket rate limiter shared between processes
+
+    The bucket state lives in a small JSON file which is only read and
+    written while holding an exclusive flock on it, so every process using
+    the same file draws from the same bucket."""
+
+    def __init__(self, path, rate, burst=None):
+        self._path = path
+        self._rate = float(rate)
+        self._burst = float(burst) if burst is not None \
+            else max(self._rate, 1.0)
+
+    def _take(self, fd):
+        """Try to take a token, return the time to wait if none are left"""
+        now = time.time()
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            state = json.loads(os.read(fd, 4096).decode('utf-8'))
+            tokens = state['tokens']
+            tokens += (now - state['time']) * self._rate
+            tokens = min(tokens, self._burst)
+        except (ValueError, KeyError):
+            tokens = self._burst
+
+        wait = 0.0
+        if tokens >= 1.0:
+            tokens -= 1.0
+        else:
+            wait = (1.0 - tokens) / self._rate
+
+        data = json.dumps({'tokens': tokens, 'time': now}).encode('utf-8')
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, data)
+        return wait
+
+    def acquire(self, deadline=None):
+        """Block until a call is allowed, returning the time spent queued
+
+        Returns None, without taking a token, if no call is allowed before
+        the (epoch) deadline."""
+        start = time.time()
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            while True:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    wait = self._take(fd)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                if not wait:
+                    break
+                if deadline is not None and time.time() + wait > deadline:
+                    return None
+                time.sleep(wait)
+        finally:
+            os.close(fd)
+
+        return time.time() - start
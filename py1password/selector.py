@@ -0,0 +1,133 @@
+import re
+import functools
+
+# Shorthands for the usual place of item fields
+ALIASES = {'section': ('details', 'sections'), 'field': ('fields',)}
+
+_STEP = re.compile(r'^(\w+)(?:\[([^\]]*)\])?$')
+
+
+def _split(spec):
+    """Split a selector on the dots which are not inside brackets"""
+    steps = list()
+    depth = 0
+    start = 0
+    for i, c in enumerate(spec):
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+        elif c == '.' and depth == 0:
+            steps.append(spec[start:i])
+            start = i + 1
+    steps.append(spec[start:])
+    return steps
+
+
+def _key(name):
+    def step(values):
+        for value in values:
+            if isinstance(value, dict) and name in value:
+                yield value[name]
+    return step
+
+
+def _index(n):
+    def step(values):
+        for value in values:
+            if isinstance(value, list) and -len(value) <= n < len(value):
+                yield value[n]
+    return step
+
+
+def _every(values):
+    for value in values:
+        if isinstance(value, list):
+            for elem in value:
+                yield elem
+
+
+def _match(conditions):
+    def step(values):
+        for value in values:
+            if not isinstance(value, list):
+                continue
+            for elem in value:
+                if isinstance(elem, dict) and \
+                        all(k in elem and str(elem[k]) == v
+                            for k, v in conditions):
+                    yield elem
+    return step
+
+
+def _condition(spec, text):
+    key, sep, value = text.partition('=')
+    if not sep or not key.strip():
+        raise ValueError("Invalid condition \"{}\" in selector \"{}\""
+                         .format(text, spec))
+    return key.strip(), value.strip()
+
+
+class fieldselector:
+    """Compiled selector extracting values from items
+
+    A selector is a dotted path of keys, each optionally followed by
+    ``[*]`` (every element of a list), ``[n]`` (element n) or
+    ``[key=value,...]`` (elements with all the given values), e.g.
+    ``section[*].field[t=Passphrase,k=concealed].v``. ``section`` and
+    ``field`` are shorthands for ``details.sections`` and ``fields``. A
+    path which doesn't exist in an item matches nothing."""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self._steps = list()
+        for text in _split(spec):
+            m = _STEP.match(text.strip())
+            if m is None:
+                raise ValueError("Invalid step \"{}\" in selector \"{}\""
+                                 .format(text, spec))
+            name, cond = m.groups()
+            for key in ALIASES.get(name, (name,)):
+                self._steps.append(_key(key))
+
+            if cond is None:
+                continue
+            cond = cond.strip()
+            if cond == '*':
+                self._steps.append(_every)
+            elif re.match(r'^-?\d+$', cond):
+                self._steps.append(_index(int(cond)))
+            else:
+                self._steps.append(_match(
+                    [_condition(spec, c) for c in cond.split(',')]))
+
+    def _values(self, item):
+        values = iter((item,))
+        for step in self._steps:
+            values = step(values)
+        return values
+
+    def all(self, item):
+        """Return every value matched in item"""
+        return list(self._values(item))
+
+    def first(self, item, default=None):
+        """Return the first value matched in item"""
+        return next(self._values(item), default)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_selector(spec):
+    """Return the compiled selector for spec"""
+    return fieldselector(spec)
+
+
+def extract(items, selectors):
+    """Extract named values from each of items in a single pass
+
+    selectors maps names to selectors; the result holds, for each item, a
+    dict of the first value each selector matched (or None)."""
+    compiled = [(name, compile_selector(spec))
+                for name, spec in selectors.items()]
+    return [dict((name, sel.first(item)) for name, sel in compiled)
+            for item in items]
@@ -0,0 +1,194 @@
+import os
+import json
+import sqlite3
+import threading
+import contextlib
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    uuid TEXT PRIMARY KEY,
+    title TEXT,
+    category TEXT,
+    vault TEXT,
+    updated TEXT,
+    version TEXT,
+    detail_version TEXT,
+    overview TEXT
+);
+CREATE INDEX IF NOT EXISTS items_title ON items (title COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS items_category ON items (category);
+CREATE INDEX IF NOT EXISTS items_vault ON items (vault);
+CREATE INDEX IF NOT EXISTS items_updated ON items (updated);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT NOT NULL,
+    uuid TEXT NOT NULL,
+    PRIMARY KEY (tag, uuid)
+);
+CREATE INDEX IF NOT EXISTS tags_uuid ON tags (uuid);
+CREATE TABLE IF NOT EXISTS fields (
+    uuid TEXT NOT NULL,
+    section TEXT,
+    label TEXT,
+    kind TEXT,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS fields_label ON fields (label, value);
+CREATE INDEX IF NOT EXISTS fields_uuid ON fields (uuid);
+"""
+
+
+def _version(obj):
+    """Key used to tell if an item changed"""
+    return json.dumps([obj.get('itemVersion'), obj.get('updatedAt')])
+
+
+def _fields(item):
+    """Yield (section, label, kind, value) of the fields of an item
+
+    Concealed fields (passwords, passphrases) are left out."""
+    details = item.get('details', dict())
+    for field in details.get('fields', []):
+        if field.get('type') == 'P' or \
+                field.get('designation') == 'password':
+            continue
+        yield (None, field.get('name'), field.get('type'),
+               field.get('value'))
+
+    for sect in details.get('sections', []):
+        for field in sect.get('fields', []):
+            if field.get('k') == 'concealed':
+                continue
+            yield (sect.get('title'), field.get('t'), field.get('k'),
+                   field.get('v'))
+
+
+class itemstore:
+    """Indexed store of the vault overview in a SQLite database
+
+    The database runs in WAL mode so several processes can read it while
+    one updates it. Rows are only rewritten when the version of an item
+    changes. Field values are indexed from fetched items, except for
+    concealed fields which are never written to disk."""
+
+    def __init__(self, path, timeout=30):
+        self._path = path
+        self._timeout = timeout
+        self._local = threading.local()
+
+        # Create the database private to the user
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+        self._db().executescript(_SCHEMA)
+
+    def _db(self):
+        # Connections are per thread and must not be used across a fork
+        db, pid = getattr(self._local, 'db', (None, None))
+        if db is None or pid != os.getpid():
+            db = sqlite3.connect(self._path, timeout=self._timeout,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db, os.getpid()
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def update_list(self, items):
+        """Bring the store in line with a full item list
+
+        Returns the number of items added, changed or removed."""
+        with self._transaction() as db:
+            known = dict(db.execute('SELECT uuid, version FROM items'))
+            changed = 0
+            for obj in items:
+                uuid = obj['uuid']
+                version = _version(obj)
+                if known.pop(uuid, None) == version:
+                    continue
+
+                overview = obj.get('overview', dict())
+                db.execute('DELETE FROM tags WHERE uuid = ?', (uuid,))
+                db.execute('DELETE FROM fields WHERE uuid = ?', (uuid,))
+                db.execute('INSERT OR REPLACE INTO items (uuid, title, '
+                           'category, vault, updated, version, overview) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (uuid, overview.get('title'),
+                            obj.get('templateUuid'), obj.get('vaultUuid'),
+                            obj.get('updatedAt'), version,
+                            json.dumps(overview)))
+                db.executemany('INSERT OR IGNORE INTO tags (tag, uuid) '
+                               'VALUES (?, ?)',
+                               [(tag, uuid)
+                                for tag in overview.get('tags', [])])
+                changed += 1
+
+            # Whatever is left is no longer in the vault
+            for uuid in known:
+                for table in ('items', 'tags', 'fields'):
+                    db.execute('DELETE FROM {} WHERE uuid = ?'.format(table),
+                               (uuid,))
+            return changed + len(known)
+
+    def update_item(self, item):
+        """Index the fields of a fetched item"""
+        uuid = item['uuid']
+        version = _version(item)
+        with self._transaction() as db:
+            row = db.execute('SELECT detail_version FROM items '
+                             'WHERE uuid = ?', (uuid,)).fetchone()
+            if row is None or row[0] == version:
+                return
+            db.execute('DELETE FROM fields WHERE uuid = ?', (uuid,))
+            db.executemany('INSERT INTO fields (uuid, section, label, kind, '
+                           'value) VALUES (?, ?, ?, ?, ?)',
+                           [(uuid,) + field for field in _fields(item)])
+            db.execute('UPDATE items SET detail_version = ? WHERE uuid = ?',
+                       (version, uuid))
+
+    def find(self, title=None, category=None, vault=None, tag=None,
+             updated_since=None, field=None, value=None):
+        """Return the uuids of items matching all of the given criteria
+
+        title is matched without case, updated_since is an ISO 8601 time
+        and field / value match the label and value of an item field."""
+        where = list()
+        params = list()
+        if title is not None:
+            where.append('title = ? COLLATE NOCASE')
+            params.append(title)
+        if category is not None:
+            where.append('category = ?')
+            params.append(category)
+        if vault is not None:
+            where.append('vault = ?')
+            params.append(vault)
+        if updated_since is not None:
+            where.append('updated >= ?')
+            params.append(updated_since)
+        if tag is not None:
+            where.append('uuid IN (SELECT uuid FROM tags WHERE tag = ?)')
+            params.append(tag)
+        if field is not None or value is not None:
+            sub = list()
+            if field is not None:
+                sub.append('label = ?')
+                params.append(field)
+            if value is not None:
+                sub.append('value = ?')
+                params.append(value)
+            where.append('uuid IN (SELECT uuid FROM fields WHERE {})'
+                         .format(' AND '.join(sub)))
+
+        sql = 'SELECT uuid FROM items'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY title'
+        return [row[0] for row in self._db().execute(sql, params)]
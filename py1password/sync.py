@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .op import onepassword
+from . import diff
+
+MANIFEST = '.op-sync.json'
+
+
+def parse_target(spec):
+    """Parse a sync target given as ``TAG:DIR[:MODE]``"""
+    parts = spec.split(':')
+    if len(parts) not in (2, 3):
+        raise ValueError("Sync target \"{}\" is not TAG:DIR[:MODE]"
+                         .format(spec))
+    mode = int(parts[2], 8) if len(parts) == 3 else 0o600
+    return parts[0], (os.path.expanduser(parts[1]), mode)
+
+
+class onepasswordSync(onepassword):
+    """Download tagged documents from the vault into directories
+
+    Each target directory keeps a manifest of the item version of every
+    document written to it, so unchanged documents are not downloaded
+    again."""
+
+    def __init__(self, *args, jobs=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._jobs = jobs
+        self._print_lock = threading.Lock()
+
+    def _read_manifest(self, path):
+        try:
+            with open(os.path.join(path, MANIFEST), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _write_manifest(self, path, manifest):
+        fd, tmp = tempfile.mkstemp(dir=path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, os.path.join(path, MANIFEST))
+
+    def _report(self, txt, result):
+        if self._verbose:
+            with self._print_lock:
+                self._print(txt)
+                print(result, file=sys.stderr)
+
+    def _sync_one(self, obj, path, mode, manifest, changed):
+        uuid = obj['uuid']
+        version = diff.version(obj)
+
+        entry = manifest.get(uuid, None)
+        if uuid not in changed and \
+                os.path.isfile(os.path.join(path, entry['filename'])):
+            self._report("File \"{}\" unchanged".format(entry['filename']),
+                         "SKIPPED")
+            return entry
+
+        item = self.get_items([uuid])[0]
+        try:
+            filename = item['details']['documentAttributes']['fileName']
+        except KeyError:
+            self._report("Item \"{}\" is not a document"
+                         .format(obj['overview'].get('title', uuid)),
+                         "SKIPPED")
+            return None
+
+        filename = os.path.basename(filename)
+        dest = os.path.join(path, filename)
+
+        self.save_document(uuid, dest, mode)
+        self._report("Writing \"{}\"".format(filename), "Done.")
+        return {'filename': filename, 'version': version}
+
+    def sync(self, targets, overwrite=False):
+        """Download the documents tagged for each target
+
+        targets maps a tag to a tuple of (directory, file mode). Tags
+        sharing a directory share its manifest."""
+        items = dict((obj['uuid'], obj) for obj in self._items)
+
+        dirs = dict()
+        for tag, (path, mode) in targets.items():
+            dirs.setdefault(os.path.abspath(path), list()).append((tag, mode))
+
+        for path, tags in dirs.items():
+            os.makedirs(path, mode=0o700, exist_ok=True)
+            manifest = self._read_manifest(path)
+            new = dict()
+            for tag, mode in tags:
+                objs = [items[uuid] for uuid in self.find_items_tag(tag)
+                        if uuid in items]
+                new.update(self._sync_tag(objs, path, mode, manifest,
+                                          overwrite))
+
+            self._write_manifest(path, new)
+
+    def _sync_tag(self, objs, path, mode, manifest, overwrite):
+        # Only download documents added or modified since last time
+        if overwrite:
+            changed = set(obj['uuid'] for obj in objs)
+        else:
+            changed = set(diff.changed(diff.diff_versions(
+                dict((uuid, entry['version'])
+                     for uuid, entry in manifest.items()),
+                diff.versions(objs))))
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as pool:
+            futures = dict((obj['uuid'], pool.submit(
+                self._sync_one, obj, path, mode, manifest, changed))
+                for obj in objs)
+            new = dict()
+            for uuid, future in futures.items():
+                entry = future.result()
+                if entry is not None:
+                    new[uuid] = entry
+        return new
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+
+# Trace context passed to child processes
+ENV_FILE = 'OP_TRACE_FILE'
+ENV_PARENT = 'OP_TRACE_PARENT'
+
+_events = os.environ.get(ENV_FILE, None)
+_root_parent = os.environ.get(ENV_PARENT, None)
+_local = threading.local()
+_ids = iter(range(1, 1 << 62))
+_ids_lock = threading.Lock()
+
+
+def enabled():
+    return _events is not None
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = list()
+    return stack
+
+
+def current():
+    """Return the id of the innermost open span"""
+    stack = _stack()
+    if stack:
+        return stack[-1]['id']
+    return _root_parent
+
+
+def _new_id():
+    with _ids_lock:
+        return '{}-{}'.format(os.getpid(), next(_ids))
+
+
+def _write(event):
+    # A single O_APPEND write keeps lines from processes intact
+    data = (json.dumps(event) + '\n').encode('utf-8')
+    fd = os.open(_events, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def span(name, parent=None, **args):
+    """Record the enclosed code as a span of the trace
+
+    parent defaults to the innermost open span of this thread."""
+    if _events is None:
+        yield
+        return
+
+    frame = {'id': _new_id(), 'args': dict(args)}
+    frame['args']['parent'] = parent or current()
+    frame['args']['id'] = frame['id']
+    _stack().append(frame)
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        _stack().pop()
+        _write({'name': name, 'cat': 'py1password', 'ph': 'X',
+                'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+                'pid': os.getpid(), 'tid': threading.get_ident() & 0xffff,
+                'args': frame['args']})
+
+
+def annotate(**args):
+    """Add arguments to the innermost open span"""
+    stack = _stack()
+    if stack:
+        stack[-1]['args'].update(args)
+
+
+def traced(name=None):
+    """Decorator recording each call of a function as a span"""
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def child_env(env):
+    """Propagate the trace context into a child environment"""
+    if _events is not None:
+        env[ENV_FILE] = _events
+        parent = current()
+        if parent is not None:
+            env[ENV_PARENT] = parent
+    return env
+
+
+def start(filename):
+    """Start tracing this process and its children to filename"""
+    global _events
+    _events = filename + '.events'
+    if os.path.exists(_events):
+        os.unlink(_events)
+
+
+def finish(filename):
+    """Stop tracing and write a Chrome trace (JSON) to filename"""
+    global _events
+    events = list()
+    try:
+        with open(_events, 'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+        os.unlink(_events)
+    except OSError:
+        pass
+    _events = None
+
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,156 @@
+import os
+import sys
+import errno
+import shutil
+import signal
+import select
+import tempfile
+import threading
+
+# SSH_ASKPASS shim: hand the request to the zygote and print the answer
+_SHIM = """#!/bin/sh
+r="{dir}/r.$$"
+mkfifo -m 600 "$r" || exit 1
+printf '%s %s\\n' "$$" "$SSH_KEY_UUID" > "{dir}/req"
+cat "$r"
+rm -f "$r"
+"""
+
+
+class _Timeout(BaseException):
+    pass
+
+
+def _timeout(signum, frame):
+    raise _Timeout()
+
+
+class askpassZygote:
+    """Pre-forked process answering askpass prompts
+
+    The zygote is forked from the onepasswordSSH process so it already
+    has the modules imported and the session and item cache in memory.
+    SSH_ASKPASS points at a small shell shim which writes the request to a
+    fifo; the zygote forks a child per request which looks up the
+    passphrase and writes it back on a per-request fifo. Passphrases the
+    parent already knows are registered with the zygote beforehand, the
+    others are looked up by the child. The zygote exits when the parent
+    closes it or exits itself."""
+
+    def __init__(self, op, timeout=60):
+        self._op = op
+        self._timeout = int(timeout)
+        self._known = dict()
+        self._lock = threading.Lock()
+        self._dir = tempfile.mkdtemp(prefix='op-zygote-')
+        self._request = os.path.join(self._dir, 'req')
+        os.mkfifo(self._request, 0o600)
+
+        self.shim = os.path.join(self._dir, 'askpass')
+        with open(os.open(self.shim, os.O_CREAT | os.O_WRONLY, 0o700),
+                  'w') as f:
+            f.write(_SHIM.format(dir=self._dir))
+
+        alive, self._alive = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self._pid = os.fork()
+        if self._pid == 0:
+            os.close(self._alive)
+            try:
+                self._serve(alive)
+            finally:
+                os._exit(0)
+        os.close(alive)
+
+    def register(self, uuid, passphrase):
+        """Hand a known passphrase to the zygote for the next prompt
+
+        Returns False if the zygote is not running."""
+        line = '{} {}\n'.format(
+            uuid, passphrase.encode(self._op._encoding).hex())
+        with self._lock:
+            if self._alive is None:
+                return False
+            try:
+                os.write(self._alive, line.encode('ascii'))
+            except OSError:
+                return False
+        return True
+
+    def _serve(self, alive):
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        req = os.open(self._request, os.O_RDWR | os.O_NONBLOCK)
+
+        buf = b''
+        known = b''
+        while True:
+            try:
+                ready, _, _ = select.select([req, alive], [], [])
+            except InterruptedError:
+                continue
+            if alive in ready:
+                # Passphrases the parent already knows come before the
+                # requests for them, an empty read means the parent closed
+                # its end or exited
+                data = os.read(alive, 4096)
+                if not data:
+                    shutil.rmtree(self._dir, ignore_errors=True)
+                    return
+                known += data
+                while b'\n' in known:
+                    line, known = known.split(b'\n', 1)
+                    parts = line.decode('ascii', 'replace').split()
+                    if len(parts) == 2:
+                        self._known[parts[0]] = parts[1]
+                continue
+
+            try:
+                buf += os.read(req, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                parts = line.decode('ascii', 'replace').split()
+                if len(parts) == 2 and parts[0].isdigit():
+                    self._answer(parts[0], parts[1],
+                                 self._known.pop(parts[1], None))
+
+    def _answer(self, pid, uuid, known):
+        if os.fork():
+            return
+
+        # Child answering one prompt. The shim waits on the reply fifo,
+        # so it always gets an answer, empty if the lookup failed or
+        # timed out.
+        try:
+            signal.signal(signal.SIGALRM, _timeout)
+            passphrase = ''
+            try:
+                signal.alarm(self._timeout)
+                if known is not None:
+                    passphrase = bytes.fromhex(known).decode(
+                        self._op._encoding)
+                else:
+                    passphrase = self._op.get_passphrase(uuid)
+            except (Exception, _Timeout):
+                pass
+            # Give up if the shim is gone and never opens its end
+            signal.alarm(self._timeout)
+            fifo = os.path.join(self._dir, 'r.{}'.format(pid))
+            with open(fifo, 'w', encoding=self._op._encoding) as f:
+                f.write(passphrase + '\n')
+        finally:
+            os._exit(0)
+
+    def close(self):
+        """Stop the zygote"""
+        with self._lock:
+            if self._alive is None:
+                return
+            os.close(self._alive)
+            self._alive = None
+        os.waitpid(self._pid, 0)
+        shutil.rmtree(self._dir, ignore_errors=True)
@@ -12,7 +12,11 @@ setup(name='py1password',
       packages=['py1password'],
       entry_points={
         'console_scripts':
-        ['op-askpass=py1password.command_line:askpass',
+        ['op-askpass=py1password.askpass:main',
          'op-unlock=py1password.command_line:add_keys_to_agent',
-         'op-getkey=py1password.command_line:download_key'],
+         'op-getkey=py1password.command_line:download_key',
+         'op-agent=py1password.command_line:agent_proxy',
+         'op-mirror=py1password.command_line:vault_mirror',
+         'op-sync=py1password.command_line:sync_documents',
+         'op-diff=py1password.command_line:diff_vault'],
         })
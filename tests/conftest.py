@@ -0,0 +1,68 @@
+import os
+import json
+import pytest
+
+STAND_IN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'stand_in')
+
+
+def key_item(uuid, name, passphrase):
+    """An SSH_KEY item as the stand-in op returns it"""
+    return {'uuid': uuid, 'title': name, 'tags': ['SSH_KEY'],
+            'details': {'sections': [{'fields': [
+                {'t': 'KeyName', 'k': 'string', 'v': name},
+                {'t': 'Passphrase', 'k': 'concealed', 'v': passphrase}]}]}}
+
+
+class fakeOp:
+    """Handle on the state of the stand-in op cli"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def set_vault(self, items):
+        with open(os.path.join(self.path, 'vault.json'), 'w') as f:
+            json.dump(items, f)
+
+    def expire(self):
+        """Invalidate the current session token"""
+        with open(os.path.join(self.path, 'token'), 'w') as f:
+            f.write('')
+
+    def offline(self):
+        """Make the service unreachable"""
+        with open(os.path.join(self.path, 'offline'), 'w') as f:
+            f.write('')
+
+    def signins(self):
+        try:
+            with open(os.path.join(self.path, 'signins'), 'r') as f:
+                return int(f.read())
+        except OSError:
+            return 0
+
+    def calls(self):
+        try:
+            with open(os.path.join(self.path, 'calls.log'), 'r') as f:
+                return [line.strip() for line in f]
+        except OSError:
+            return list()
+
+
+@pytest.fixture
+def fake_op(tmp_path, monkeypatch):
+    """Put the stand-in op cli on the PATH with a private home"""
+    state = tmp_path / 'op'
+    state.mkdir()
+    monkeypatch.setenv('FAKE_OP_STATE', str(state))
+    monkeypatch.setenv('PATH', STAND_IN + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    for name in list(os.environ):
+        if name.startswith('OP_'):
+            monkeypatch.delenv(name)
+
+    op = fakeOp(str(state))
+    op.set_vault([key_item('key{}'.format(n), 'key{}'.format(n),
+                           'pass{}'.format(n)) for n in range(16)])
+    return op
@@ -0,0 +1,29 @@
+import pytest
+from py1password.opssh import onepasswordSSH
+
+
+def _child_env(op, passphrase):
+    rtn = op._ssh_askpass(['env'], 'key3', passphrase)
+    return dict(line.split('=', 1) for line in
+                rtn.stdout.decode().splitlines() if '=' in line)
+
+
+@pytest.mark.parametrize('zygote', [False, True])
+def test_session_not_inherited(fake_op, tmp_path, monkeypatch, zygote):
+    with open(fake_op.path + '/token', 'w') as f:
+        f.write('token1')
+    monkeypatch.setenv('OP_SESSION_my', 'token1')
+    monkeypatch.setenv('OP_SERVICE_ACCOUNT_TOKEN', 'service1')
+    op = onepasswordSSH(quiet=True, cache_path=str(tmp_path / 'cache'),
+                        zygote=zygote)
+    try:
+        env = _child_env(op, 'x')
+        assert 'OP_SESSION_my' not in env
+        assert 'OP_SERVICE_ACCOUNT_TOKEN' not in env
+        if not zygote:
+            # Without a known passphrase op-askpass needs the credentials
+            env = _child_env(op, None)
+            assert env['OP_SERVICE_ACCOUNT_TOKEN'] == 'service1'
+    finally:
+        if op._zygote is not None:
+            op._zygote.close()
@@ -0,0 +1,67 @@
+import pytest
+from py1password import index
+from py1password.opssh import onepasswordSSH
+
+
+def _obj(uuid, title, tags=()):
+    return {'uuid': uuid, 'overview': {'title': title, 'tags': list(tags)}}
+
+
+@pytest.fixture
+def write(tmp_path):
+    def write(items):
+        path = str(tmp_path / 'index')
+        index.write(path, items)
+        return index.itemindex(path)
+    return write
+
+
+def test_round_trip(write):
+    idx = write([_obj('b2', 'Clé SSH', ['SSH_KEY', 'été']),
+                 _obj('a1', 'github', ['SSH_KEY']),
+                 _obj('c3', 'github'),
+                 _obj('d4', '鍵', ['été'])])
+    assert len(idx) == 4
+    assert 'a1' in idx and 'zz' not in idx
+    assert idx.title('b2') == 'Clé SSH'
+    assert idx.title('d4') == '鍵'
+    assert idx.title('zz') is None
+    assert idx.find_title('github') == ['a1', 'c3']
+    assert idx.find_title('鍵') == ['d4']
+    assert idx.find_title('missing') == []
+    assert sorted(idx.find_tag('SSH_KEY')) == ['a1', 'b2']
+    assert sorted(idx.find_tag('été')) == ['b2', 'd4']
+    assert idx.find_tag('none') == []
+    idx.close()
+
+
+def test_empty(write):
+    idx = write([])
+    assert len(idx) == 0
+    assert 'a1' not in idx
+    assert idx.find_title('') == []
+    assert idx.find_tag('SSH_KEY') == []
+    idx.close()
+
+
+def test_not_an_index(tmp_path):
+    path = tmp_path / 'index'
+    path.write_bytes(b'not an index at all, just some bytes')
+    with pytest.raises(ValueError):
+        index.itemindex(str(path))
+
+
+def test_names_resolved_from_index(fake_op, tmp_path):
+    op = onepasswordSSH(quiet=True, persistent_cache=True,
+                        cache_path=str(tmp_path / 'cache'))
+    assert op._index is not None
+    uuids = op.find_items_tag('SSH_KEY')
+    items, tags = op._list
+    op._list = (list(), tags)
+    assert op._resolve_key_names(['key3', 'nokey'], uuids) == \
+        {'key3': 'key3'}
+
+    # Without an index the decoded list is scanned
+    op._index = None
+    op._list = (items, tags)
+    assert op._resolve_key_names(['key3'], uuids) == {'key3': 'key3'}
@@ -0,0 +1,80 @@
+import os
+import grp
+import threading
+import pytest
+from py1password.opssh import onepasswordSSH
+from py1password.mirror import vaultMirror
+
+
+@pytest.fixture
+def mirror(fake_op, tmp_path):
+    op = onepasswordSSH(quiet=True, cache_path=str(tmp_path / 'server'))
+    server = vaultMirror(op, str(tmp_path / 'mirror.sock'), list_ttl=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(mirror, tmp_path, name):
+    return onepasswordSSH(quiet=True, mirror=mirror.server_address,
+                          cache_path=str(tmp_path / name))
+
+
+def test_clients_share_lookups(fake_op, mirror, tmp_path):
+    clients = [_client(mirror, tmp_path, 'client{}'.format(n))
+               for n in range(3)]
+
+    for client in clients:
+        assert sorted(client.find_items_tag('SSH_KEY')) == \
+            sorted('key{}'.format(n) for n in range(16))
+        assert client.get_passphrase('key3') == 'pass3'
+        assert client.get_items(['key5'])[0]['uuid'] == 'key5'
+
+    # The clients never run op, the mirror fetches each item once
+    calls = fake_op.calls()
+    assert calls.count('get item key3') == 1
+    assert calls.count('get item key5') == 1
+    assert all(call.startswith(('signin', 'list', 'get'))
+               for call in calls)
+    assert fake_op.signins() == 1
+
+
+def test_missing_item(fake_op, mirror, tmp_path):
+    from py1password.op import NotFoundError
+    client = _client(mirror, tmp_path, 'client')
+    with pytest.raises(NotFoundError):
+        client.get_items(['nokey'])
+
+
+def test_concurrent_lists(fake_op, mirror, tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_OP_DELAY', '0.2')
+    mirror._list_ttl = 0.1
+    mirror._listed = 0
+    before = fake_op.calls().count('list items')
+    threads = [threading.Thread(target=_client,
+                                args=(mirror, tmp_path, 'c{}'.format(n)))
+               for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The stale list is refreshed once, not by every handler at once
+    assert fake_op.calls().count('list items') - before == 1
+
+
+def test_allowed(fake_op, tmp_path):
+    op = onepasswordSSH(quiet=True, cache_path=str(tmp_path / 'server'))
+    private = vaultMirror(op, str(tmp_path / 'private.sock'))
+    group = grp.getgrgid(os.getgid()).gr_name
+    shared = vaultMirror(op, str(tmp_path / 'shared.sock'), group=group)
+    try:
+        assert private.allowed(os.getuid(), os.getgid())
+        assert not private.allowed(54321, 54321)
+        assert shared.allowed(54321, os.getgid())
+        assert not shared.allowed(54321, 54321)
+    finally:
+        private.server_close()
+        shared.server_close()
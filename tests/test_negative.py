@@ -0,0 +1,29 @@
+import argparse
+import pytest
+from conftest import key_item
+from py1password.opssh import onepasswordSSH
+from py1password.command_line import _check_missing
+
+
+def _key_file(uuid, name):
+    return {'uuid': uuid, 'title': name, 'tags': ['SSH_KEY_FILE'],
+            'details': {'documentAttributes': {'fileName': name},
+                        'sections': [{'fields': [
+                            {'t': 'KeyName', 'k': 'string', 'v': name}]}]},
+            'document': 'private key'}
+
+
+def test_misses_kept_per_tag(fake_op, tmp_path):
+    fake_op.set_vault([key_item('key1', 'bar', 'pass1'),
+                       _key_file('file1', 'foo')])
+    op = onepasswordSSH(quiet=True, persistent_cache=True,
+                        keys_path=str(tmp_path))
+    with pytest.raises(RuntimeError):
+        op.save_ssh_keys(['bar'])
+
+    args = argparse.Namespace(persistent_cache=True, domain='my',
+                              all=False, keys=['bar'])
+    # bar has no key file, but it is still a key op-unlock can add
+    _check_missing('SSH_KEY', args)
+    with pytest.raises(RuntimeError):
+        _check_missing('SSH_KEY_FILE', args)
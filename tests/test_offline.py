@@ -0,0 +1,63 @@
+import io
+import os
+import pytest
+from conftest import key_item
+from py1password.op import onepassword, OpUnavailable
+
+
+def _document(uuid, content):
+    return {'uuid': uuid, 'title': uuid, 'tags': ['DOC'],
+            'details': {'documentAttributes': {'fileName': uuid}},
+            'document': content}
+
+
+@pytest.fixture
+def snapshot(fake_op, tmp_path):
+    """Take a snapshot of the vault, then make the service unreachable"""
+    fake_op.set_vault([key_item('key1', 'key1', 'pass1'),
+                       _document('doc1', 'contents')])
+    op = onepassword(quiet=True, offline=True,
+                     cache_path=str(tmp_path / 'cache'))
+    op.get_items(['key1'])
+    op.save_document('doc1', str(tmp_path / 'doc1'))
+    fake_op.offline()
+    return str(tmp_path / 'cache')
+
+
+@pytest.mark.parametrize('expired', [False, True])
+def test_served_from_snapshot(fake_op, tmp_path, snapshot, expired):
+    if expired:
+        # The session usually expired too, and signin can't reach op
+        fake_op.expire()
+    op = onepassword(quiet=True, offline=True, cache_path=snapshot)
+    assert op.find_items_tag('SSH_KEY') == ['key1']
+    assert op.get_items(['key1'])[0]['uuid'] == 'key1'
+
+    filename = str(tmp_path / 'saved')
+    op.save_document('doc1', filename)
+    with open(filename, 'r') as f:
+        assert f.read() == 'contents'
+    assert op.stats()['offline_hits'] == 3
+
+
+def test_partial_stream_replaced(fake_op, tmp_path, snapshot, monkeypatch):
+    op = onepassword(quiet=True, offline=True, cache_path=snapshot)
+
+    def partial(cmd, stdout=None):
+        stdout.write(b'cont')
+        raise OpUnavailable("i/o timeout")
+
+    monkeypatch.setattr(op, '_op_call', partial)
+    monkeypatch.setattr(op, '_degraded', False)
+    monkeypatch.setattr(op, '_set_degraded', lambda err: None)
+    out = io.BytesIO()
+    op._run_op(['op', 'get', 'document', 'doc1'], out)
+    assert out.getvalue() == b'contents'
+
+
+def test_not_offline(fake_op, tmp_path):
+    fake_op.offline()
+    with pytest.raises(RuntimeError):
+        onepassword(quiet=True, login_tries=1,
+                    cache_path=str(tmp_path / 'cache'))
+    assert not os.path.exists(str(tmp_path / 'cache' / 'my-snapshot'))
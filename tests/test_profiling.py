@@ -0,0 +1,28 @@
+import pstats
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from py1password import profiling
+
+
+def _in_thread():
+    return sum(range(100))
+
+
+def _in_pool():
+    return sum(range(100))
+
+
+def _work():
+    thread = threading.Thread(target=_in_thread)
+    thread.start()
+    thread.join()
+    with ThreadPoolExecutor(2) as pool:
+        list(pool.map(lambda n: _in_pool(), range(4)))
+
+
+def test_threads_profiled(tmp_path):
+    filename = str(tmp_path / 'profile')
+    profiling.run(filename, _work)
+
+    names = set(func[2] for func in pstats.Stats(filename).stats)
+    assert {'_work', '_in_thread', '_in_pool'} <= names
@@ -0,0 +1,18 @@
+from py1password.selector import fieldselector
+
+
+def test_every_element():
+    item = {'overview': {'tags': ['SSH_KEY', 'work']},
+            'details': {'sections': [{'fields': [1, {'v': 'a'}]}]}}
+    assert fieldselector('overview.tags[*]').all(item) == ['SSH_KEY', 'work']
+    assert fieldselector('section[*].field[*]').all(item) == [1, {'v': 'a'}]
+    assert fieldselector('overview.tags[-1]').first(item) == 'work'
+
+
+def test_conditions():
+    item = {'details': {'sections': [{'fields': [
+        {'t': 'KeyName', 'k': 'string', 'v': 'name'},
+        {'t': 'Passphrase', 'k': 'concealed', 'v': 'secret'}]}]}}
+    sel = fieldselector('section[*].field[t=Passphrase,k=concealed].v')
+    assert sel.all(item) == ['secret']
+    assert fieldselector('section[*].field[t=Missing].v').first(item) is None
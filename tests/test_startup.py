@@ -0,0 +1,19 @@
+import os
+import sys
+import subprocess
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks', 'askpass_startup.py')
+
+
+def test_askpass_startup_budget():
+    rtn = subprocess.run([sys.executable, BENCHMARK, '-n', '10'],
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    assert rtn.returncode == 0, rtn.stdout.decode()
+
+
+def test_version_is_lazy():
+    rtn = subprocess.run(
+        [sys.executable, '-c', 'import sys, py1password.askpass; '
+         'print("subprocess" in sys.modules)'], stdout=subprocess.PIPE)
+    assert rtn.stdout.strip() == b'False'
@@ -0,0 +1,29 @@
+import os
+from py1password.sync import onepasswordSync
+
+
+def _document(uuid, tag, filename, content):
+    return {'uuid': uuid, 'title': filename, 'tags': [tag],
+            'details': {'documentAttributes': {'fileName': filename}},
+            'document': content}
+
+
+def test_tags_sharing_a_directory(fake_op, tmp_path):
+    fake_op.set_vault([_document('doc1', 'cert', 'host.pem', 'cert'),
+                       _document('doc2', 'kube', 'config', 'kube')])
+    dest = str(tmp_path / 'dest')
+    targets = {'cert': (dest, 0o600), 'kube': (dest, 0o640)}
+
+    op = onepasswordSync(quiet=True, cache_path=str(tmp_path / 'cache'))
+    op.sync(targets)
+    assert sorted(os.listdir(dest)) == ['.op-sync.json', 'config', 'host.pem']
+    with open(os.path.join(dest, 'config'), 'r') as f:
+        assert f.read() == 'kube'
+    assert os.stat(os.path.join(dest, 'config')).st_mode & 0o777 == 0o640
+
+    # Nothing changed, so nothing is downloaded again
+    calls = len(fake_op.calls())
+    onepasswordSync(quiet=True, cache_path=str(tmp_path / 'cache')).sync(
+        targets)
+    assert not [call for call in fake_op.calls()[calls:]
+                if call.startswith('get')]
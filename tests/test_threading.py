@@ -0,0 +1,63 @@
+import threading
+from py1password.op import onepassword
+
+
+def _hammer(op, uuids):
+    """Fetch every uuid from its own thread, all starting together"""
+    barrier = threading.Barrier(len(uuids))
+    results = dict()
+    errors = list()
+
+    def fetch(uuid):
+        barrier.wait()
+        try:
+            results[uuid] = op.get_items([uuid])[0]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=fetch, args=(uuid,))
+               for uuid in uuids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert sorted(results) == sorted(uuids)
+    assert all(results[uuid]['uuid'] == uuid for uuid in uuids)
+
+
+def test_one_signin_per_expiry(fake_op, monkeypatch, tmp_path):
+    monkeypatch.setenv('FAKE_OP_DELAY', '0.05')
+    op = onepassword(quiet=True, cache_path=str(tmp_path / 'cache'),
+                     cache_size=0)
+    assert fake_op.signins() == 1
+
+    uuids = ['key{}'.format(n) for n in range(16)]
+    for expiry in range(1, 4):
+        fake_op.expire()
+        _hammer(op, uuids)
+        assert fake_op.signins() == 1 + expiry
+
+
+def test_list_swapped_with_index(fake_op, tmp_path):
+    op = onepassword(quiet=True, cache_path=str(tmp_path / 'cache'))
+    items, tags = op._list
+    stop = threading.Event()
+    seen = list()
+
+    def read():
+        while not stop.is_set():
+            items, tags = op._list
+            seen.append(len(items) == len(tags.get('SSH_KEY', [])))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        for n in range(50):
+            op._get_list('items')
+    finally:
+        stop.set()
+        reader.join()
+
+    assert seen and all(seen)
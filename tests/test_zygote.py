@@ -0,0 +1,41 @@
+import os
+import time
+import subprocess
+from py1password.opssh import onepasswordSSH
+from py1password.zygote import askpassZygote
+
+
+def _prompt(shim, uuid):
+    env = os.environ.copy()
+    env['SSH_KEY_UUID'] = uuid
+    return subprocess.run([shim], env=env, stdout=subprocess.PIPE,
+                          timeout=10).stdout.decode()
+
+
+def test_known_passphrase(fake_op, tmp_path):
+    op = onepasswordSSH(quiet=True, cache_path=str(tmp_path / 'cache'),
+                        zygote=True)
+    cmd = ['sh', '-c', 'echo "$SSH_ASKPASS"; "$SSH_ASKPASS"']
+    try:
+        calls = len(fake_op.calls())
+        rtn = op._ssh_askpass(cmd, 'key3', 'registered')
+        assert rtn.stdout.decode() == op._zygote.shim + '\nregistered\n'
+        assert len(fake_op.calls()) == calls
+
+        # Unknown passphrases are looked up by the zygote
+        rtn = op._ssh_askpass(cmd, 'key4')
+        assert rtn.stdout.decode() == op._zygote.shim + '\npass4\n'
+    finally:
+        op._zygote.close()
+
+
+def test_timeout_answers(fake_op, tmp_path, monkeypatch):
+    op = onepasswordSSH(quiet=True, cache_path=str(tmp_path / 'cache'))
+    monkeypatch.setenv('FAKE_OP_DELAY', '5')
+    zygote = askpassZygote(op, timeout=1)
+    try:
+        start = time.time()
+        assert _prompt(zygote.shim, 'key3') == '\n'
+        assert time.time() - start < 4
+    finally:
+        zygote.close()